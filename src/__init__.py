@@ -1,4 +1,5 @@
 import os
+import weakref
 from logging.config import dictConfig
 
 from flask import Flask, jsonify
@@ -66,7 +67,52 @@ def create_app(test_config=None):
         # Set the location of the database file called paralympics.sqlite
         # which will be in the app's instance folder
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path,
-                                                            'src.sqlite'))
+                                                            'src.sqlite'),
+        # Reload the data tables at startup if df_prepared.csv has changed
+        # since it was loaded, otherwise refuse to start
+        RESEED_ON_DATA_CHANGE=False,
+        # The largest page that the list routes return with ?limit=
+        MAX_PAGE_SIZE=1000,
+        # Encode reads from row tuples instead of Marshmallow schemas, using
+        # orjson if it is installed
+        FAST_SERIALIZATION=False,
+        FAST_SERIALIZATION_ORJSON=True,
+        # Rows fetched from the database at a time for streamed responses
+        STREAM_BATCH_SIZE=1000,
+        # Cache-Control header for GET responses; clients revalidate with
+        # the ETag, which is answered with 304 if the table has not changed
+        CACHE_CONTROL="no-cache",
+        # The GET response cache, shared by all the worker processes in a
+        # SQLite file ("sqlite"), or held in each process ("memory"). See
+        # src.cache.make_cache(). Set the size to 0 to turn the cache off
+        RESPONSE_CACHE_BACKEND="sqlite",
+        RESPONSE_CACHE_PATH=None,
+        RESPONSE_CACHE_MAX_BYTES=32 * 1024 * 1024,
+        RESPONSE_CACHE_TTL=300,
+        # Serve reads of the data tables from a copy in each worker process,
+        # see src.snapshot. Writes by other processes are picked up within
+        # SNAPSHOT_MAX_AGE seconds
+        SNAPSHOT_READS=True,
+        SNAPSHOT_MAX_AGE=1.0,
+        # The most sub-requests in a request to /batch, and the threads that
+        # run its GET sub-requests at the same time (1 to run them in turn)
+        BATCH_MAX_REQUESTS=20,
+        BATCH_WORKERS=4,
+        # The most verified auth tokens cached in each process, and the most
+        # seconds a token's user is cached for. Set the size to 0 to look up
+        # the user of every request
+        TOKEN_CACHE_SIZE=1024,
+        TOKEN_CACHE_TTL=60,
+        # The werkzeug method and parameters passwords are hashed with.
+        # Stored hashes made with other parameters are rehashed at login
+        PASSWORD_HASH_METHOD="scrypt:32768:8:1",
+        # The processes that hash passwords, and the seconds a request waits
+        # for one before it is answered with 503. Set to 0 to hash on the
+        # request thread
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_TIMEOUT=5,
+        # Days a refresh token from /login or /token/refresh can be used for
+        REFRESH_TOKEN_DAYS=30)
 
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -93,17 +139,64 @@ def create_app(test_config=None):
     # calling create_all, otherwise SQLAlchemy
     # will not know about them.
     from src.models import User, Feedback, Age_group, Gender, Ethnicity, \
-        Employment, Course_level, Teacher, Disability
+        Employment, Course_level, Teacher, Disability, Data_source, \
+        Table_version, Cube_cell, Refresh_token
+    # Count the writes to each table, used for the ETags of GET responses
+    from src import versions
+    # Keep the cube of aggregates up to date with writes to the records
+    from src import cube
+    # Cache GET responses until the tables they read are written to
+    from src.cache import make_cache
+    cache = make_cache(app)
+    if cache:
+        app.extensions['response_cache'] = cache
+        versions.add_commit_listener(app, cache.invalidate)
+    # Cache the users of verified tokens until the user changes
+    if app.config['TOKEN_CACHE_SIZE']:
+        from src.cache import TokenCache
+        token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'],
+                                 app.config['TOKEN_CACHE_TTL'])
+        app.extensions['token_cache'] = token_cache
+    # Hash passwords in worker processes, off the request threads
+    from src.passwords import PasswordHasher, method_prefix
+    # Check the hash method, and find the prefix its hashes are stored with
+    method_prefix(app.config['PASSWORD_HASH_METHOD'])
+    if app.config['PASSWORD_HASH_WORKERS']:
+        hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_TIMEOUT'])
+        app.extensions['password_hasher'] = hasher
+        # Stop the workers when the app is gone, or at exit
+        weakref.finalize(app, hasher.shutdown)
+    # Run the GET sub-requests of /batch requests at the same time
+    if app.config['BATCH_WORKERS'] > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        app.extensions['batch_pool'] = ThreadPoolExecutor(
+            app.config['BATCH_WORKERS'], thread_name_prefix='batch')
     # Create the tables in the database
     # create_all does not update tables if they are already in the database.
     with app.app_context():
         db.create_all()
 
-        # Add the data to the database if not already added
+        # Add the data to the database if not already added, this is a
+        # single lookup when the data file has not changed
         from src.utils import add_data
         add_data(db)
+
+        # Read the snapshot of the data tables before the first request
+        if app.config['SNAPSHOT_READS']:
+            from src.snapshot import SnapshotStore
+            store = SnapshotStore(app.config['SNAPSHOT_MAX_AGE'])
+            store.get(db.session)
+            app.extensions['snapshot'] = store
+            versions.add_commit_listener(app, store.invalidate)
         # Register the routes with the app in the context
 
         from src import routes, error_handlers
 
+    # Register the CLI commands, e.g. flask --app src reload-data
+    from src.commands import reload_data_command, ingest_command
+    app.cli.add_command(reload_data_command)
+    app.cli.add_command(ingest_command)
+
     return app
@@ -0,0 +1,120 @@
+# Several sub-requests dispatched within one HTTP request to /batch
+from flask import current_app as app, request
+from werkzeug.test import EnvironBuilder
+
+from src import db
+
+# The methods a sub-request may use; GET sub-requests only read
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+
+# The headers of the batch request that sub-requests are sent with, unless
+# a sub-request sets them itself
+SHARED_HEADERS = ('Authorization', 'Accept')
+
+
+def check_item(item):
+    """Returns why an item of a batch is not a valid sub-request, or None.
+
+    Args:
+        item: The item from the request body, a dict with the 'method' and
+            'path' of the sub-request and optionally a JSON 'body' and a
+            dict of 'headers'
+    """
+    if not isinstance(item, dict) or not isinstance(item.get('path'), str) \
+            or not item['path'].startswith('/'):
+        return "Each sub-request must have a 'path' that starts with /."
+    if item.get('method', 'GET').upper() not in METHODS:
+        return f"The method must be one of {', '.join(METHODS)}."
+    if not isinstance(item.get('headers', {}), dict):
+        return "The 'headers' must be an object."
+    if item['path'].split('?')[0].rstrip('/') == request.path.rstrip('/'):
+        return "Batch requests cannot be nested."
+    return None
+
+
+def sub_environ(item):
+    """Returns the WSGI environ of a sub-request of the current request."""
+    headers = {name: request.headers[name] for name in SHARED_HEADERS
+               if name in request.headers}
+    headers.update(item.get('headers', {}))
+    builder = EnvironBuilder(
+        path=item['path'], method=item.get('method', 'GET').upper(),
+        base_url=request.host_url, headers=headers, json=item.get('body'),
+        environ_base={'REMOTE_ADDR': request.remote_addr})
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def dispatch(flask_app, environ):
+    """Runs a sub-request through the app's routes.
+
+    The request context is pushed within the current app context, if there
+    is one, so the sub-request uses the same database session.
+
+    Returns:
+        dict of the response's 'status', 'headers' and 'body', the body is
+        the decoded JSON if the response is JSON
+    """
+    with flask_app.request_context(environ):
+        try:
+            response = flask_app.full_dispatch_request()
+        except Exception as e:
+            flask_app.logger.error(f"An error occurred in a sub-request: {str(e)}")
+            db.session.rollback()
+            return {'status': 500, 'headers': {},
+                    'body': {'message': "An Internal Server Error occurred."}}
+        body = response.get_data()
+        return {'status': response.status_code,
+                'headers': dict(response.headers),
+                'body': response.get_json(silent=True)
+                if response.is_json else body.decode(errors='replace')}
+
+
+def run_batch(items):
+    """Runs the sub-requests of a batch and returns their responses.
+
+    The sub-requests run in order. A run of consecutive GET sub-requests
+    only reads, so it is run on the app's thread pool, each in its own app
+    context and database session. Every other sub-request runs on this
+    thread in the batch request's app context and session, so it sees the
+    writes of the sub-requests before it.
+
+    Args:
+        items: list of the sub-requests, see check_item()
+
+    Returns:
+        list of the responses of the sub-requests, in the same order, see
+        dispatch()
+    """
+    flask_app = app._get_current_object()
+    pool = flask_app.extensions.get('batch_pool')
+    results = [None] * len(items)
+    reads = []
+
+    def run_reads():
+        if pool and len(reads) > 1:
+            futures = [(index, pool.submit(dispatch, flask_app, environ))
+                       for index, environ in reads]
+            for index, future in futures:
+                results[index] = future.result()
+        else:
+            for index, environ in reads:
+                results[index] = dispatch(flask_app, environ)
+        reads.clear()
+
+    for index, item in enumerate(items):
+        error = check_item(item)
+        if error:
+            results[index] = {'status': 400, 'headers': {},
+                              'body': {'message': error}}
+            continue
+        environ = sub_environ(item)
+        if environ['REQUEST_METHOD'] == 'GET':
+            reads.append((index, environ))
+        else:
+            run_reads()
+            results[index] = dispatch(flask_app, environ)
+    run_reads()
+    return results
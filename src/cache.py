@@ -0,0 +1,365 @@
+# Caches of GET responses, in process or shared between processes, and of
+# verified auth tokens
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# A cached response and what is needed to check that it is still valid
+Entry = namedtuple("Entry", "expires tables versions status headers body")
+
+
+class MemoryCache:
+    """In-process LRU cache of responses with a TTL and a memory bound.
+
+    Each entry records the tables its response was read from and their
+    versions. An entry is only returned while those versions are current,
+    and invalidate() drops the entries for tables that have changed.
+
+    Attributes:
+        max_bytes: The most response body and header bytes to hold
+        ttl: Seconds an entry is kept for
+        hits: The number of get() calls that found a valid entry
+        misses: The number of get() calls that did not
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._by_table = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        """Returns the cached (status, headers, body) for key, or None.
+
+        Args:
+            key: The cache key of the request
+            versions: dict of the current version of each table
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires < time.monotonic() \
+                    or any(versions.get(table) != version
+                           for table, version in entry.versions.items()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.status, entry.headers, entry.body
+
+    def set(self, key, versions, status, headers, body):
+        """Adds a response to the cache, evicting the least recently used.
+
+        Args:
+            key: The cache key of the request
+            versions: dict of the version of each table the response read
+            status: The HTTP status code
+            headers: list of (name, value) header tuples
+            body: The response body bytes
+        """
+        size = len(body) + sum(len(k) + len(v) for k, v in headers)
+        if size > self.max_bytes:
+            return
+        entry = Entry(time.monotonic() + self.ttl, frozenset(versions),
+                      dict(versions), status, headers, body)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._sizes[key] = size
+            self._size += size
+            for table in entry.tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tables):
+        """Drops every entry that was read from any of the tables."""
+        with self._lock:
+            for table in tables:
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._by_table.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= self._sizes.pop(key)
+        for table in entry.tables:
+            keys = self._by_table[table]
+            keys.discard(key)
+            if not keys:
+                del self._by_table[table]
+
+
+class SQLiteCache:
+    """LRU cache of responses in a SQLite file shared by all processes.
+
+    Every worker process opens the same file, so a response cached by one
+    worker is served by all of them and an invalidation made by one is seen
+    by all of them at once. It has the same methods as MemoryCache.
+
+    get() only reads the file. The uses of entries for LRU eviction, and
+    the entries found stale, are kept in the process and written by the
+    next set().
+
+    Attributes:
+        path: The SQLite file
+        max_bytes: The most response body and header bytes to hold
+        ttl: Seconds an entry is kept for
+        hits: The number of get() calls in this process that found a valid
+            entry
+        misses: The number of get() calls in this process that did not
+    """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        # The times entries were last used by get() in this process, and the
+        # entries it found stale, written to the file by the next set() so
+        # that reads do not write
+        self._used = {}
+        self._stale = set()
+        with self._connection() as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS entry (
+                    key TEXT PRIMARY KEY,
+                    expires REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    versions TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    body BLOB NOT NULL);
+                CREATE INDEX IF NOT EXISTS entry_last_used
+                    ON entry (last_used);
+                CREATE TABLE IF NOT EXISTS entry_table (
+                    key TEXT NOT NULL
+                        REFERENCES entry (key) ON DELETE CASCADE,
+                    table_name TEXT NOT NULL,
+                    PRIMARY KEY (table_name, key));
+                CREATE INDEX IF NOT EXISTS entry_table_key
+                    ON entry_table (key);
+            """)
+
+    def _connection(self):
+        """Returns this thread's connection, opening it if needed.
+
+        Connections are not shared between threads or forked processes.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key, versions):
+        """Returns the cached (status, headers, body) for key, or None.
+
+        Args:
+            key: The cache key of the request
+            versions: dict of the current version of each table
+        """
+        row = self._connection().execute(
+            "SELECT expires, versions, status, headers, body "
+            "FROM entry WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or key in self._stale or row[0] < now or any(
+                versions.get(table) != version
+                for table, version in json.loads(row[1]).items()):
+            if row is not None:
+                self._stale.add(key)
+            self.misses += 1
+            return None
+        self._used[key] = now
+        self.hits += 1
+        headers = [tuple(header) for header in json.loads(row[3])]
+        return row[2], headers, row[4]
+
+    def set(self, key, versions, status, headers, body):
+        """Adds a response to the cache, evicting the least recently used.
+
+        Args:
+            key: The cache key of the request
+            versions: dict of the version of each table the response read
+            status: The HTTP status code
+            headers: list of (name, value) header tuples
+            body: The response body bytes
+        """
+        size = len(body) + sum(len(k) + len(v) for k, v in headers)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        connection = self._connection()
+        used, self._used = self._used, {}
+        stale, self._stale = self._stale | {key}, set()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "UPDATE entry SET last_used = MAX(last_used, ?) "
+                "WHERE key = ?",
+                [(used_at, key) for key, used_at in used.items()])
+            connection.executemany("DELETE FROM entry WHERE key = ?",
+                                   [(key,) for key in stale])
+            connection.execute(
+                "INSERT INTO entry VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, now + self.ttl, now, size, json.dumps(versions),
+                 status, json.dumps(headers), body))
+            connection.executemany(
+                "INSERT INTO entry_table VALUES (?, ?)",
+                [(key, table) for table in versions])
+            total = connection.execute(
+                "SELECT SUM(size) FROM entry").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop the least recently used entries that take the total
+                # over the bound
+                connection.execute("""
+                    DELETE FROM entry WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (
+                                ORDER BY last_used DESC, key) AS running
+                            FROM entry)
+                        WHERE running > ?)""", (self.max_bytes,))
+
+    def invalidate(self, tables):
+        """Drops every entry that was read from any of the tables."""
+        tables = list(tables)
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                f"DELETE FROM entry WHERE key IN (SELECT key FROM entry_table "
+                f"WHERE table_name IN ({', '.join('?' * len(tables))}))",
+                tables)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entry")
+
+
+class TokenCache:
+    """In-process LRU cache of the users of verified auth tokens.
+
+    Entries are keyed by a digest of the token, so the tokens themselves
+    are not held. An entry is kept until the token expires, or for at most
+    ttl seconds so that a change to the user made by another process is
+    seen within that time. invalidate() drops the entries of users that
+    are changed or deleted in this process.
+
+    Attributes:
+        max_entries: The most tokens to hold
+        ttl: The most seconds an entry is kept for
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the user cached for the token digest key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, user_id, user = entry
+            if expires <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, key, user_id, expires, user):
+        """Caches the user of a token, evicting the least recently used.
+
+        Args:
+            key: The digest of the token
+            user_id: The id of the user, used by invalidate()
+            expires: The time the token expires, as a Unix timestamp
+            user: The user to cache, e.g. a dict of its column values
+        """
+        expires = min(expires, time.time() + self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, user_id, user)
+            self._by_user.setdefault(user_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user_ids):
+        """Drops the entries of the users with the given ids."""
+        with self._lock:
+            for user_id in user_ids:
+                for key in list(self._by_user.get(user_id, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _remove(self, key):
+        user_id = self._entries.pop(key)[1]
+        keys = self._by_user[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._by_user[user_id]
+
+
+def make_cache(app):
+    """Creates the response cache configured for an app.
+
+    RESPONSE_CACHE_BACKEND may be "memory" for a cache in each process,
+    "sqlite" for a cache shared by every process using the file at
+    RESPONSE_CACHE_PATH, or a function that takes the app and returns an
+    object with the same methods as MemoryCache.
+
+    Returns:
+        The cache, or None if RESPONSE_CACHE_MAX_BYTES is 0
+    """
+    config = app.config
+    backend = config["RESPONSE_CACHE_BACKEND"]
+    if not config["RESPONSE_CACHE_MAX_BYTES"]:
+        return None
+    if callable(backend):
+        return backend(app)
+    if backend == "memory":
+        return MemoryCache(config["RESPONSE_CACHE_MAX_BYTES"],
+                           config["RESPONSE_CACHE_TTL"])
+    if backend == "sqlite":
+        path = config["RESPONSE_CACHE_PATH"]
+        if not path:
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, "response_cache.sqlite")
+        return SQLiteCache(path, config["RESPONSE_CACHE_MAX_BYTES"],
+                           config["RESPONSE_CACHE_TTL"])
+    raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND {backend!r}")
@@ -0,0 +1,50 @@
+# Flask CLI commands for managing the data in the database
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from src import db
+from src.utils import DATA_FILE, reload_data, ingest_files
+
+
+@click.command('reload-data')
+@click.argument('path', required=False,
+                type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def reload_data_command(path):
+    """Apply the changes in df_prepared.csv (or PATH) to the data tables."""
+    try:
+        counts = reload_data(db, path or DATA_FILE)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Inserted {counts['inserted']}, updated {counts['updated']} "
+               f"and deleted {counts['deleted']} rows.")
+
+
+@click.command('ingest')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Rows inserted and committed at a time.')
+@click.option('--workers', default=1, show_default=True,
+              help='Processes used to read the files in parallel.')
+@with_appcontext
+def ingest_command(paths, chunk_size, workers):
+    """Append the rows of the files in PATHS.
+
+    The files may be CSV (plain or .gz), Parquet or Arrow IPC files.
+    """
+    start = time.perf_counter()
+    file_rows = dict.fromkeys(paths, 0)
+
+    def progress(path, rows):
+        file_rows[path] += rows
+        rate = sum(file_rows.values()) / (time.perf_counter() - start)
+        click.echo(f"{path}: {file_rows[path]} rows ({rate:,.0f} rows/s)")
+
+    total = ingest_files(db, list(paths), chunk_size=chunk_size,
+                         workers=workers, progress=progress)
+    elapsed = time.perf_counter() - start
+    click.echo(f"Added {total} rows from {len(paths)} file(s) in "
+               f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s).")
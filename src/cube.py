@@ -0,0 +1,177 @@
+# Precomputed aggregates of the records for each combination of dimensions
+from sqlalchemy import event, tuple_
+from sqlalchemy.orm import Session
+
+from src import db
+from src.models import Cube_cell
+from src.records import RECORD_MODELS, DIMENSIONS, record_columns, \
+    select_records, aggregate_encoder, select_aggregates
+from src.serializers import RowEncoder
+
+# The dimension value of the cells that sum all the values of a dimension
+ROLLUP = 'Total'
+
+# The dimensions that a cell is looked up by within each time period. The
+# dataset already has 'Total' rows for these, so only time_period is rolled
+# up; summing the other dimensions would count the 'Total' rows twice.
+SERIES = ('course_level_recoded', 'qts_status', 'employment_status')
+
+# The ids of the record tables, used to find the records a write changed
+_record_ids = {model.__table__: column
+               for model in RECORD_MODELS
+               for column in model.__table__.primary_key}
+
+
+def cube_encoder():
+    """Returns the encoder for cells, with the keys sorted as Flask does.
+
+    time_period is stored as text so that it can hold ROLLUP, it is
+    selected as an integer, as the other routes return it, for the cells
+    of a single time period.
+    """
+    columns = dict(Cube_cell.__table__.c.items())
+    time_period = columns['time_period']
+    columns['time_period'] = db.case(
+        (time_period == ROLLUP, time_period),
+        else_=db.cast(time_period, db.Integer)).label('time_period')
+    keys = tuple(sorted(columns))
+    return RowEncoder(keys, tuple(columns[key] for key in keys))
+
+
+def cell_keys(session, ids):
+    """Returns the (course_level, qts_status, employment_status) of records.
+
+    Args:
+        session: The SQLAlchemy session
+        ids: Iterable of record ids, ids without a complete record are
+            ignored
+
+    Returns:
+        set of tuples of the SERIES values
+    """
+    columns = record_columns()
+    ids = list(ids)
+    keys = set()
+    # Keep under SQLite's limit on the number of parameters
+    for start in range(0, len(ids), 500):
+        keys.update(tuple(row) for row in session.execute(
+            select_records(*(columns[name] for name in SERIES))
+            .where(columns['record_id'].in_(ids[start:start + 500]))
+            .distinct()))
+    return keys
+
+
+def update_cube(session, keys=None):
+    """Recomputes the cells of the cube for some or all of the series.
+
+    Each cell has the dimension values, n_total, count and the weighted
+    means of the percentages of its records, as returned by /aggregate. A
+    cell with time_period 'Total' aggregates every time period of a series.
+
+    Args:
+        session: The SQLAlchemy session, the caller commits
+        keys: Optional set of tuples of the SERIES values whose cells are
+            recomputed, if None the whole cube is rebuilt
+    """
+    series_columns = [record_columns()[name] for name in SERIES]
+    cells = db.delete(Cube_cell)
+    by_period = select_aggregates(DIMENSIONS)
+    totals = select_aggregates(SERIES)
+    if keys is not None:
+        if not keys:
+            return
+        keys = list(keys)
+        cells = cells.where(tuple_(
+            *(getattr(Cube_cell, name) for name in SERIES)).in_(keys))
+        by_period = by_period.where(tuple_(*series_columns).in_(keys))
+        totals = totals.where(tuple_(*series_columns).in_(keys))
+    session.execute(cells)
+    rows = aggregate_encoder(DIMENSIONS).dicts(session.execute(by_period))
+    for row in rows:
+        row['time_period'] = str(row['time_period'])
+    for row in aggregate_encoder(SERIES).dicts(session.execute(totals)):
+        row['time_period'] = ROLLUP
+        rows.append(row)
+    if rows:
+        session.execute(db.insert(Cube_cell), rows)
+
+
+@event.listens_for(Session, 'before_flush')
+def _find_changed_records(session, flush_context, instances):
+    """Finds the series of the records a flush changes or deletes."""
+    ids = {getattr(o, _record_ids[o.__table__].key)
+           for o in (*session.dirty, *session.deleted)
+           if o.__table__ in _record_ids}
+    if ids:
+        session.info.setdefault('cube_keys', set()).update(
+            cell_keys(session, ids))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_changed_records(session, flush_context):
+    """Recomputes the cells of the records a flush added, changed or
+    deleted, before and after the change."""
+    ids = {getattr(o, _record_ids[o.__table__].key)
+           for o in (*session.new, *session.dirty)
+           if o.__table__ in _record_ids}
+    keys = session.info.pop('cube_keys', set())
+    if ids:
+        keys |= cell_keys(session, ids)
+    if keys:
+        update_cube(session, keys)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _find_statement_records(orm_execute_state):
+    """Finds the records a DML statement on a record table changes.
+
+    The ids are taken from the parameters of an insert or of an ORM bulk
+    update by primary key, or read with the WHERE clause of an update or
+    delete before it runs. The series of those records before the
+    statement, and after it, are recomputed at commit. If the records are
+    not known, e.g. an insert without ids or a statement without a WHERE
+    clause, the whole cube is rebuilt instead.
+    """
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.local_table not in _record_ids:
+        return
+    session = orm_execute_state.session
+    pk = _record_ids[mapper.local_table]
+    parameters = orm_execute_state.parameters
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    where = None if orm_execute_state.is_insert \
+        else orm_execute_state.statement.whereclause
+    if where is not None:
+        ids = session.scalars(db.select(pk).where(where)).all()
+    elif parameters and all(row.get(pk.key) is not None
+                            for row in parameters):
+        ids = [row[pk.key] for row in parameters]
+    else:
+        session.info['rebuild_cube'] = True
+        return
+    # An insert may replace existing records, see upsert_statement()
+    session.info.setdefault('cube_keys', set()).update(
+        cell_keys(session, ids))
+    session.info.setdefault('cube_ids', set()).update(ids)
+
+
+@event.listens_for(Session, 'before_commit')
+def _rebuild_cube(session):
+    """Rebuilds the cube, or the cells of the records statements changed."""
+    keys = session.info.pop('cube_keys', set())
+    ids = session.info.pop('cube_ids', set())
+    if session.info.pop('rebuild_cube', False):
+        update_cube(session)
+    elif keys or ids:
+        update_cube(session, keys | cell_keys(session, ids))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('cube_keys', None)
+    session.info.pop('cube_ids', None)
+    session.info.pop('rebuild_cube', None)
@@ -1,15 +1,29 @@
+import base64
+import binascii
 import datetime
+import hashlib
+import json
+import secrets
+import time
 from functools import wraps
 import jwt
-from flask import request, make_response, current_app as app
+from flask import request, make_response, abort, url_for, g, \
+    has_app_context, current_app as app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
 from src import db
-from src.models import User
+from src.models import User, Refresh_token
+from src.versions import table_versions
+from src.snapshot import current_store
 
 
 def token_required(f):
     """Require valid jwt for a route
 
-    Decorator to protect routes using jwt
+    Decorator to protect routes using jwt. The logged in user is set as
+    g.current_user. Users of verified tokens are cached until the token
+    expires, see src.cache.TokenCache, so most requests do not decode the
+    token or query the user.
     """
 
     @wraps(f)
@@ -24,20 +38,173 @@ def token_required(f):
         if not token:
             response = {"message": "Authentication Token missing"}
             return make_response(response, 401)
-        # Check the token is valid
-        token_payload = decode_auth_token(token)
-        user_id = token_payload["sub"]
-        # Find the user in the database using their email address which is in
-        # the data of the decoded token
-        current_user = db.session.execute(
-            db.select(User).filter_by(user_id=user_id)).scalar_one_or_none()
-        if not current_user:
-            response = {"message": "Invalid or missing token."}
-            return make_response(response, 401)
+        cache = app.extensions.get("token_cache")
+        key = hashlib.sha256(token.encode()).hexdigest()
+        values = cache.get(key) if cache else None
+        if values is not None:
+            current_user = cached_user(values)
+        else:
+            # Check the token is valid, if not the 401 response is returned
+            token_payload = decode_auth_token(token)
+            if not isinstance(token_payload, dict):
+                return token_payload
+            # Find the user in the database using the user id which is in the
+            # data of the decoded token
+            current_user = db.session.execute(
+                db.select(User).filter_by(user_id=token_payload["sub"])
+            ).scalar_one_or_none()
+            if not current_user:
+                response = {"message": "Invalid or missing token."}
+                return make_response(response, 401)
+            if cache:
+                cache.set(key, current_user.user_id, token_payload["exp"], {
+                    column.key: getattr(current_user, column.key)
+                    for column in User.__table__.c})
+        g.current_user = current_user
         return f(*args, **kwargs)
     return decorator
 
 
+def cached_user(values):
+    """Returns a User in the session from its cached column values.
+
+    The user is merged into the session without loading it from the
+    database.
+
+    :param values: dict of the column values of the user
+    :return: User
+    """
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(Session, 'after_flush')
+def _find_flushed_users(session, flush_context):
+    """Finds the users a flush changes or deletes."""
+    ids = {o.user_id for o in session.deleted if isinstance(o, User)}
+    ids.update(o.user_id for o in session.dirty
+               if isinstance(o, User) and session.is_modified(o))
+    if ids:
+        session.info.setdefault('changed_users', set()).update(ids)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _find_statement_users(orm_execute_state):
+    """Finds the users a DML statement on the user table changes.
+
+    The ids are read with the WHERE clause of an update or delete before it
+    runs, or taken from the parameters. A new user has no tokens, so an
+    insert without ids is ignored; other statements whose users are not
+    known drop every cached token.
+    """
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None or mapper.class_ is not User:
+        return
+    session = orm_execute_state.session
+    parameters = orm_execute_state.parameters
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    where = None if orm_execute_state.is_insert \
+        else orm_execute_state.statement.whereclause
+    if where is not None:
+        ids = session.scalars(db.select(User.user_id).where(where)).all()
+    elif parameters and all(row.get('user_id') is not None
+                            for row in parameters):
+        ids = [row['user_id'] for row in parameters]
+    elif orm_execute_state.is_insert:
+        return
+    else:
+        session.info['all_users_changed'] = True
+        return
+    session.info.setdefault('changed_users', set()).update(ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_tokens(session):
+    """Drops the cached tokens of the users a commit changed or deleted."""
+    ids = session.info.pop('changed_users', None)
+    all_users = session.info.pop('all_users_changed', False)
+    cache = app.extensions.get("token_cache") if has_app_context() else None
+    if cache is None:
+        return
+    if all_users:
+        cache.clear()
+    elif ids:
+        cache.invalidate(ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('changed_users', None)
+    session.info.pop('all_users_changed', None)
+
+
+def conditional_get(*models):
+    """Adds ETags, Cache-Control headers and response caching to a GET route.
+
+    The strong ETag is derived from the version counters of the tables the
+    route reads, the request path and query string, and the Accept header.
+    The versions are those of the app's snapshot if it holds the tables.
+    If it matches the If-None-Match header, 304 Not Modified is returned
+    without calling the route.
+
+    Otherwise a response cached for the same request is returned if the
+    tables have not changed since it was cached. Responses are cached when
+    the app has a response cache, see create_app().
+
+    :param models: the model classes of the tables the route reads
+    """
+    tables = [model.__tablename__ for model in models]
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            store = current_store()
+            versions = store and store.versions(db.session, tables)
+            if versions is None:
+                versions = table_versions(db.session, tables)
+            key = request_key()
+            etag = hashlib.sha1(
+                repr((key, sorted(versions.items()))).encode()).hexdigest()
+            cache = app.extensions.get("response_cache")
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            elif cache and (cached := cache.get(key, versions)):
+                status, headers, body = cached
+                response = app.response_class(body, status=status,
+                                              headers=headers)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if cache and not response.is_streamed:
+                    cache.set(key, versions, response.status_code,
+                              list(response.headers.items()),
+                              response.get_data())
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = app.config["CACHE_CONTROL"]
+            response.vary.add("Accept")
+            return response
+        return wrapper
+    return decorator
+
+
+def request_key():
+    """Returns a key that identifies the response to the current request.
+
+    The settings that change how responses are encoded are included, so
+    the key changes whenever the response body could change.
+    """
+    return repr((request.endpoint, sorted(request.view_args.items()),
+                 request.query_string, request.headers.get("Accept", ""),
+                 app.config["FAST_SERIALIZATION"],
+                 app.config["FAST_SERIALIZATION_ORJSON"]))
+
+
 def encode_auth_token(user_id):
     """Generates the Auth Token
 
@@ -53,7 +220,8 @@ def encode_auth_token(user_id):
                 "exp": datetime.datetime.now
                 (datetime.UTC) + datetime.timedelta(minutes=5),
                 "iat": datetime.datetime.now(datetime.UTC),
-                "sub": user_id,
+                # PyJWT requires the subject to be a string
+                "sub": str(user_id),
             },
             # Flask app secret key, matches the key used in the decode() in
             # the decorator
@@ -70,17 +238,289 @@ def decode_auth_token(auth_token):
     """
     Decodes the auth token.
     :param auth_token:
-    :return: token payload
+    :return: token payload, with the user id 'sub' as an int, or a 401
+        response if the token is not valid
     """
     # Use PyJWT.decode(token, key, algorithms) to decode the token with the
     # public key for the app
     try:
         payload = jwt.decode(auth_token, app.config.get("SECRET_KEY"),
-                             algorithms=["HS256"])
+                             algorithms=["HS256"],
+                             options={"require": ["exp", "sub"]})
+        payload["sub"] = int(payload["sub"])
         return payload
     except jwt.ExpiredSignatureError:
         return make_response(
             {'message': "Token expired. Please log in again."}, 401)
-    except jwt.InvalidTokenError:
+    except (jwt.InvalidTokenError, ValueError):
         return make_response(
             {'message': "Invalid token. Please log in again."}, 401)
+
+
+def hash_refresh_token(token):
+    """Returns the SHA-256 hex digest that a refresh token is stored as.
+
+    Refresh tokens are long random strings, so a fast hash is enough.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_refresh_token(user_id):
+    """Creates a refresh token for a user, the caller commits.
+
+    Only the hash of the token is stored. The user's expired refresh tokens
+    are deleted.
+
+    :param user_id: The user id of the user logging in
+    :return: string the refresh token
+    """
+    token = secrets.token_urlsafe(32)
+    now = time.time()
+    db.session.execute(db.delete(Refresh_token).where(
+        Refresh_token.user_id == user_id, Refresh_token.expires < now))
+    db.session.add(Refresh_token(
+        user_id=user_id, token_hash=hash_refresh_token(token),
+        expires=now + app.config["REFRESH_TOKEN_DAYS"] * 24 * 60 * 60))
+    return token
+
+
+def use_refresh_token(token):
+    """Uses up a refresh token, so that it cannot be used again.
+
+    The token is marked as used in a single UPDATE ... RETURNING statement.
+    If a token that was already used is used again it may have been
+    stolen, so every refresh token of its user is revoked. The caller
+    commits.
+
+    :param token: The refresh token sent by the client
+    :return: int the user id of the token, or None if it is not valid
+    """
+    token_hash = hash_refresh_token(token)
+    user_id = db.session.execute(
+        db.update(Refresh_token)
+        .where(Refresh_token.token_hash == token_hash,
+               Refresh_token.revoked.is_(False),
+               Refresh_token.expires > time.time(),
+               Refresh_token.user_id.in_(db.select(User.user_id)))
+        .values(revoked=True)
+        .returning(Refresh_token.user_id)
+    ).scalar_one_or_none()
+    if user_id is None:
+        db.session.execute(
+            db.update(Refresh_token)
+            .where(Refresh_token.user_id.in_(
+                db.select(Refresh_token.user_id).where(
+                    Refresh_token.token_hash == token_hash,
+                    Refresh_token.revoked.is_(True))))
+            .values(revoked=True))
+    return user_id
+
+
+def revoke_refresh_token(token):
+    """Revokes a refresh token, the caller commits.
+
+    :param token: The refresh token sent by the client
+    :return: True if the token was found
+    """
+    return db.session.execute(
+        db.update(Refresh_token)
+        .where(Refresh_token.token_hash == hash_refresh_token(token))
+        .values(revoked=True)
+        .returning(Refresh_token.refresh_token_id)
+    ).first() is not None
+
+
+def encode_cursor(value):
+    """Encodes the last primary key of a page as an opaque cursor."""
+    return base64.urlsafe_b64encode(f"after:{value}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor made by encode_cursor().
+
+    :param cursor: string cursor from the 'after' query parameter
+    :return: int primary key, or None if the cursor is not valid
+    """
+    try:
+        prefix, value = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split(":", 1)
+        if prefix == "after":
+            return int(value)
+    except (binascii.Error, UnicodeError, ValueError):
+        pass
+    return None
+
+
+def page_args():
+    """Gets the keyset pagination parameters of the request.
+
+    'limit' is the number of rows to return, at most MAX_PAGE_SIZE.
+    'after' is the cursor returned for the previous page. If only 'after'
+    is given, MAX_PAGE_SIZE rows are returned.
+
+    :return: (after, limit) tuple, either may be None if not paginating
+    """
+    max_size = app.config["MAX_PAGE_SIZE"]
+    limit = request.args.get("limit")
+    cursor = request.args.get("after")
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if after is None:
+            abort(400, description="Invalid 'after' cursor.")
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= max_size:
+            abort(400, description=f"'limit' must be between 1 and "
+                                   f"{max_size}.")
+        limit = int(limit)
+    elif after is not None:
+        limit = max_size
+    return after, limit
+
+
+def id_args():
+    """Gets the primary keys requested with the 'ids' query parameter.
+
+    e.g. ?ids=1,5,9 for at most MAX_PAGE_SIZE ids
+
+    :return: list of int ids in the order given, or None if not given
+    """
+    ids = request.args.get("ids")
+    if ids is None:
+        return None
+    ids = [i.strip() for i in ids.split(",")]
+    max_size = app.config["MAX_PAGE_SIZE"]
+    if not all(i.isdigit() for i in ids) or len(ids) > max_size:
+        abort(400, description=f"'ids' must be a list of at most {max_size} "
+                               f"ids separated by commas.")
+    return [int(i) for i in ids]
+
+
+def field_args(names):
+    """Gets the columns requested with the 'fields' query parameter.
+
+    e.g. ?fields=time_period,n_total
+
+    :param names: the names of the fields that can be requested, e.g. the
+        columns of the table being read
+    :return: tuple of column names, or None if all columns are wanted
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return None
+    fields = tuple(dict.fromkeys(f.strip() for f in fields.split(",")))
+    unknown = [f for f in fields if f not in names]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}.")
+    return fields
+
+
+def group_args(names):
+    """Gets the columns to group by from the 'group_by' query parameter.
+
+    e.g. ?group_by=time_period,qts_status
+
+    :param names: the names of the columns that can be grouped by
+    :return: tuple of column names, empty if no grouping is wanted
+    """
+    group_by = request.args.get("group_by")
+    if not group_by:
+        return ()
+    group_by = tuple(dict.fromkeys(g.strip() for g in group_by.split(",")))
+    unknown = [g for g in group_by if g not in names]
+    if unknown:
+        abort(400, description=f"Cannot group by: {', '.join(unknown)}.")
+    return group_by
+
+
+def filter_values(columns):
+    """Gets the column filters given as query parameters.
+
+    e.g. ?qts_status=Awarded%20QTS&time_period=201819&time_period=201920
+    matches the rows with that qts_status in either time period. Values are
+    converted to the Python type of their column.
+
+    :param columns: dict of the name of each column that can be filtered on
+        to the column
+    :return: dict mapping the name of each filtered column to its values
+    """
+    filters = {}
+    for name, column in columns.items():
+        values = request.args.getlist(name)
+        if not values:
+            continue
+        try:
+            filters[name] = [column.type.python_type(value)
+                             for value in values]
+        except ValueError:
+            abort(400, description=f"Invalid value for '{name}'.")
+    return filters
+
+
+def filter_args(columns):
+    """Gets the column filters given as query parameters as conditions.
+
+    See filter_values() for the parameters.
+
+    :param columns: dict of the name of each column that can be filtered on
+        to the column
+    :return: list of SQLAlchemy conditions, one for each filtered column
+    """
+    return [columns[name].in_(values) if len(values) > 1
+            else columns[name] == values[0]
+            for name, values in filter_values(columns).items()]
+
+
+def bulk_items():
+    """Gets the items of a bulk write from the request body.
+
+    The body is a JSON array, or newline delimited JSON with a Content-Type
+    of application/x-ndjson, which is read a line at a time.
+
+    :return: list of the items, with None for an NDJSON line that is not
+        valid JSON, or None if the body is not a bulk write
+    """
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in request.stream:
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+    data = request.get_json(silent=True)
+    return data if isinstance(data, list) else None
+
+
+def stream_format():
+    """Gets the streamed response format the request asks for, if any.
+
+    ?stream=ndjson or an Accept header of application/x-ndjson asks for
+    newline delimited JSON, ?stream=json for a streamed JSON array.
+
+    :return: "ndjson", "json" or None if the response should not be streamed
+    """
+    stream = request.args.get("stream")
+    if stream is None:
+        best = request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson"])
+        return "ndjson" if best == "application/x-ndjson" else None
+    if stream not in ("ndjson", "json"):
+        abort(400, description="'stream' must be 'ndjson' or 'json'.")
+    return stream
+
+
+def set_next_page(response, last):
+    """Adds the cursor for the next page to a paginated response.
+
+    :param response: the Flask response for the current page
+    :param last: the primary key of the last row of the current page
+    """
+    cursor = encode_cursor(last)
+    args = request.args.to_dict()
+    args["after"] = cursor
+    response.headers["X-Next-Cursor"] = cursor
+    response.headers["Link"] = \
+        f'<{url_for(request.endpoint, **request.view_args, **args)}>; ' \
+        f'rel="next"'
@@ -2,7 +2,7 @@ from sqlalchemy import ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import List
 from src import db
-from werkzeug.security import generate_password_hash, check_password_hash
+from src.passwords import hash_password, check_password, needs_rehash
 
 
 class User(db.Model):
@@ -18,10 +18,13 @@ class User(db.Model):
         return '<User {}>'.format(self.email)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return check_password(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
 
 
 class Feedback(db.Model):
@@ -102,3 +105,67 @@ class Teacher(db.Model):
     time_period: Mapped[int] = mapped_column(db.Integer, nullable=False)
     qts_status: Mapped[str] = mapped_column(db.Text, nullable=False)
     n_total: Mapped[int] = mapped_column(db.Integer, nullable=False)
+
+
+class Data_source(db.Model):
+    __tablename__ = "data_source"
+    data_source_id: Mapped[int] = mapped_column(db.Integer, primary_key=True)
+    file_hash: Mapped[str] = mapped_column(db.String, nullable=False)
+    schema_version: Mapped[int] = mapped_column(db.Integer, nullable=False)
+
+
+class Table_version(db.Model):
+    __tablename__ = "table_version"
+    table_name: Mapped[str] = mapped_column(db.String, primary_key=True)
+    version: Mapped[int] = mapped_column(db.Integer, nullable=False)
+
+
+class Cube_cell(db.Model):
+    __tablename__ = "cube"
+    time_period: Mapped[str] = mapped_column(db.String, primary_key=True)
+    course_level_recoded: Mapped[str] = mapped_column(db.Text,
+                                                      primary_key=True)
+    qts_status: Mapped[str] = mapped_column(db.Text, primary_key=True)
+    employment_status: Mapped[str] = mapped_column(db.Text,
+                                                   primary_key=True)
+    n_total: Mapped[int] = mapped_column(db.Integer, nullable=False)
+    count: Mapped[int] = mapped_column(db.Integer, nullable=False)
+    pct_total_age_u25: Mapped[float] = mapped_column(db.Float, nullable=True)
+    pct_total_age_25andover: Mapped[float] = mapped_column(db.Float,
+                                                           nullable=True)
+    pct_total_sex_m: Mapped[float] = mapped_column(db.Float, nullable=True)
+    pct_total_sex_f: Mapped[float] = mapped_column(db.Float, nullable=True)
+    pct_total_ethnic_asian: Mapped[float] = mapped_column(db.Float,
+                                                          nullable=True)
+    pct_total_ethnic_black: Mapped[float] = mapped_column(db.Float,
+                                                          nullable=True)
+    pct_total_ethnic_white: Mapped[float] = mapped_column(db.Float,
+                                                          nullable=True)
+    pct_total_ethnic_mixed_ethnicity: Mapped[float] = mapped_column(
+        db.Float, nullable=True)
+    pct_total_ethnic_other: Mapped[float] = mapped_column(db.Float,
+                                                          nullable=True)
+    pct_total_ethnic_unknown: Mapped[float] = mapped_column(db.Float,
+                                                            nullable=True)
+    pct_total_disability: Mapped[float] = mapped_column(db.Float,
+                                                        nullable=True)
+    pct_total_nondisability: Mapped[float] = mapped_column(db.Float,
+                                                           nullable=True)
+    pct_total_disability_unknown: Mapped[float] = mapped_column(
+        db.Float, nullable=True)
+
+
+class Refresh_token(db.Model):
+    __tablename__ = "refresh_token"
+    refresh_token_id: Mapped[int] = mapped_column(db.Integer,
+                                                  primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user.user_id"),
+                                         index=True)
+    # SHA-256 of the token, the token itself is only known to the client
+    token_hash: Mapped[str] = mapped_column(db.String, unique=True,
+                                            nullable=False)
+    # Unix timestamp the token expires at
+    expires: Mapped[float] = mapped_column(db.Float, nullable=False)
+    # Set when the token is used, it cannot be used again, or revoked
+    revoked: Mapped[bool] = mapped_column(db.Boolean, nullable=False,
+                                          default=False)
@@ -0,0 +1,123 @@
+# Password hashing run on a process pool, off the request threads
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# The hash method and parameters used when there is no app, werkzeug's
+# scrypt default
+DEFAULT_METHOD = "scrypt:32768:8:1"
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a pool of worker processes.
+
+    At most one hash per worker runs at a time. A request that cannot get
+    a worker within timeout seconds is answered with 503 Service
+    Unavailable, so a burst of logins cannot hold every request thread.
+
+    Attributes:
+        method: The werkzeug hash method and its parameters, e.g.
+            "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+        timeout: Seconds to wait for a worker, and then for the hash
+    """
+
+    def __init__(self, method, workers, timeout):
+        self.method = method
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers)
+        # Spawn the workers so they do not inherit the app's threads and
+        # database connections
+        self._pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def hash(self, password):
+        """Returns the hash of a password with the current method."""
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        """Returns True if the password matches the hash."""
+        return self._run(check_password_hash, password_hash, password)
+
+    def _run(self, function, *args):
+        # A slot is held until the hash finishes, even after a timeout, so
+        # no more hashes are queued than there are workers
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ServiceUnavailable(
+                "The server is busy, please try again.", retry_after=1)
+        try:
+            future = self._pool.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise ServiceUnavailable(
+                "The server is busy, please try again.", retry_after=1)
+
+    def shutdown(self):
+        """Stops the worker processes, see create_app()."""
+        self._pool.shutdown(cancel_futures=True)
+
+
+def hash_method():
+    """Returns the hash method configured for the current app."""
+    if has_app_context():
+        return current_app.config["PASSWORD_HASH_METHOD"]
+    return DEFAULT_METHOD
+
+
+def _hasher():
+    return current_app.extensions.get("password_hasher") \
+        if has_app_context() else None
+
+
+def hash_password(password):
+    """Returns the hash of a password, hashed on the app's pool if it has
+    one.
+
+    Args:
+        password: The plain text password
+
+    Raises:
+        ServiceUnavailable: If no worker is free within the timeout
+    """
+    hasher = _hasher()
+    if hasher is None:
+        return generate_password_hash(password, hash_method())
+    return hasher.hash(password)
+
+
+def check_password(password_hash, password):
+    """Returns True if the password matches the hash, see hash_password()."""
+    hasher = _hasher()
+    if hasher is None:
+        return check_password_hash(password_hash, password)
+    return hasher.check(password_hash, password)
+
+
+@lru_cache(maxsize=None)
+def method_prefix(method):
+    """Returns the method and parameters werkzeug stores a hash under.
+
+    Short method names are stored with werkzeug's default parameters, e.g.
+    "pbkdf2:sha256" is stored as "pbkdf2:sha256:1000000", so the prefix is
+    read from a hash made with the method.
+    """
+    return generate_password_hash("", method).split("$", 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Returns True if a hash was made with other than the current method.
+
+    A werkzeug hash starts with its method and parameters, e.g.
+    "scrypt:32768:8:1$salt$hash".
+    """
+    return password_hash.split("$", 1)[0] != method_prefix(hash_method())
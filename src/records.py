@@ -0,0 +1,114 @@
+# The original wide rows of the dataset, joined back together from the tables
+from functools import lru_cache
+
+from sqlalchemy import inspect
+
+from src import db
+from src.models import Age_group, Gender, Ethnicity, Employment, \
+    Course_level, Teacher, Disability
+from src.serializers import RowEncoder
+
+# The tables a record is split across, joined to teacher on their ids
+RECORD_MODELS = (Teacher, Course_level, Employment, Age_group, Gender,
+                 Ethnicity, Disability)
+
+# The columns that identify a record and that records can be filtered on
+DIMENSIONS = ('time_period', 'course_level_recoded', 'qts_status',
+              'employment_status')
+
+
+@lru_cache(maxsize=None)
+def record_columns():
+    """Returns the fields of a record and the column each is read from.
+
+    The 'time_period' of a record is the teacher table's. The percentage
+    columns follow the dimensions and n_total.
+
+    Returns:
+        dict mapping each field name to its column
+    """
+    columns = {
+        'record_id': Teacher.teacher_id,
+        'time_period': Teacher.time_period,
+        'course_level_recoded': Course_level.course_level_recoded,
+        'qts_status': Teacher.qts_status,
+        'employment_status': Employment.employment_status,
+        'n_total': Teacher.n_total,
+    }
+    for model in (Age_group, Gender, Ethnicity, Disability):
+        for column in model.__table__.c:
+            if column.name.startswith('pct_'):
+                columns[column.name] = column
+    return columns
+
+
+def select_records(*columns):
+    """Returns a select of the columns that joins the tables of a record.
+
+    Every table stores the CSV row at position n with id n, so the tables
+    are joined on their primary keys.
+    """
+    query = db.select(*columns).select_from(Teacher)
+    for model in RECORD_MODELS[1:]:
+        query = query.join(
+            model, inspect(model).primary_key[0] == Teacher.teacher_id)
+    return query
+
+
+@lru_cache(maxsize=256)
+def record_encoder(fields=None):
+    """Returns the encoder for records with the given fields.
+
+    Args:
+        fields: Optional tuple of the fields to output, defaults to all
+
+    Returns:
+        A RowEncoder whose keys are sorted, as Flask sorts them
+    """
+    columns = record_columns()
+    keys = tuple(sorted(fields or columns))
+    return RowEncoder(keys, tuple(columns[key] for key in keys))
+
+
+@lru_cache(maxsize=64)
+def aggregate_encoder(group_by=()):
+    """Returns the encoder for aggregates of records grouped by columns.
+
+    Each aggregate has the values of the group_by columns, 'n_total' (the
+    sum of n_total), 'count' (the number of records) and, for each
+    percentage column, the mean of the percentages weighted by n_total.
+    The mean is null if the n_total of the group is 0.
+
+    Args:
+        group_by: Tuple of the dimensions to group by, may be empty to
+            aggregate all the records
+
+    Returns:
+        A RowEncoder whose columns are the SQL expressions of the fields
+    """
+    columns = record_columns()
+    n_total = columns['n_total']
+    total = db.func.sum(n_total)
+    expressions = {name: columns[name] for name in group_by}
+    expressions['n_total'] = total
+    expressions['count'] = db.func.count()
+    for name, column in columns.items():
+        if name.startswith('pct_'):
+            expressions[name] = db.cast(
+                db.func.sum(column * n_total), db.Float) \
+                / db.func.nullif(total, 0)
+    keys = tuple(sorted(expressions))
+    return RowEncoder(keys, tuple(expressions[key].label(key)
+                                  for key in keys))
+
+
+def select_aggregates(group_by=()):
+    """Returns a select of the aggregates of the records in each group.
+
+    See aggregate_encoder() for the fields. The groups are ordered by the
+    group_by columns.
+    """
+    columns = record_columns()
+    group_columns = [columns[name] for name in group_by]
+    return select_records(*aggregate_encoder(group_by).columns) \
+        .group_by(*group_columns).order_by(*group_columns)
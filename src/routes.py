@@ -1,15 +1,29 @@
-from flask import current_app as app, request, abort, jsonify, make_response
+from flask import current_app as app, request, abort, jsonify, \
+    make_response, stream_with_context
 
 from src import db
 from src.schemas import UserSchema, FeedbackSchema, Age_groupSchema, \
     GenderSchema, EthnicitySchema, EmploymentSchema, Course_levelSchema, \
-    TeacherSchema, DisabilitySchema
+    TeacherSchema, DisabilitySchema, projection_schema, item_schema, \
+    bulk_schema, row_schema
+from src.serializers import fast_encoder, get_encoder, dumps, stream_rows
 from src.models import User, Feedback, Age_group, Gender, Ethnicity, \
-    Employment, Course_level, Teacher, Disability
-from src.helpers import token_required, encode_auth_token
+    Employment, Course_level, Teacher, Disability, Cube_cell, Refresh_token
+from src.helpers import token_required, encode_auth_token, page_args, \
+    issue_refresh_token, use_refresh_token, revoke_refresh_token, \
+    set_next_page, id_args, field_args, filter_args, filter_values, \
+    group_args, stream_format, bulk_items, conditional_get
+from src.records import RECORD_MODELS, DIMENSIONS, record_columns, \
+    select_records, record_encoder, aggregate_encoder, select_aggregates
+from src.cube import cube_encoder
+from src.trends import metrics, load_records, compute_trends
+from src.snapshot import current_store, snapshot_table, find_records, \
+    record_dicts, aggregate_records
+from src.batch import run_batch
 
 import datetime
-from sqlalchemy import exc
+from sqlalchemy import exc, inspect
+from sqlalchemy.dialects.sqlite import insert
 from marshmallow.exceptions import ValidationError
 
 # Flask-Marshmallow Schemas
@@ -33,6 +47,408 @@ Teachers_schema = TeacherSchema(many=True)
 Teacher_schema = TeacherSchema()
 
 
+def list_resource(model, schema, name):
+    """Returns the rows of a table in JSON, in primary key order.
+
+    If the 'limit' or 'after' query parameters are given, one page of rows
+    is returned using keyset pagination on the primary key. When there are
+    more rows, the opaque cursor for the next page is returned in the
+    X-Next-Cursor header and a Link header with rel="next".
+
+    If the 'fields' query parameter is given, e.g. ?fields=time_period,n_total,
+    only those columns are selected and returned.
+
+    If FAST_SERIALIZATION is set, tables whose schema only has plain columns
+    are read as row tuples and encoded without Marshmallow.
+
+    If ?stream=ndjson or ?stream=json is given, or the Accept header is
+    application/x-ndjson, the rows are streamed, see stream_resource().
+
+    If the 'ids' query parameter is given, e.g. ?ids=1,5,9, only the rows
+    with those primary keys are returned, see get_resources(). They are
+    not paged or streamed.
+
+    Tables in the app's snapshot are read from it and not the database, see
+    src.snapshot.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema used to dump many rows
+        name: The name of the rows used in log messages
+
+    Returns:
+        JSON for the rows, 400 if the pagination parameters are invalid or
+        500 if there is a database or schema error
+    """
+    pk = inspect(model).primary_key[0]
+    after, limit = page_args()
+    fields = field_args(model.__table__.c)
+    ids = id_args()
+    stream = stream_format()
+    if ids is not None:
+        if after is not None or limit is not None \
+                or 'stream' in request.args:
+            abort(400, description="'ids' cannot be used with 'after', "
+                                   "'limit' or 'stream'.")
+        return get_resources(model, schema, ids, name, fields)
+    if stream:
+        return stream_resource(model, schema, name, fields, after, limit,
+                               stream)
+    table = snapshot_table(model)
+    if table is not None:
+        encoder = get_encoder(model, type(schema), fields)
+        rows, last = table.page(encoder.keys, after, limit)
+        response = json_response(encoder.encode(rows))
+        if last is not None:
+            set_next_page(response, last)
+        return response
+    encoder = fast_encoder(model, schema, fields)
+    if fields:
+        schema = projection_schema(schema, fields)
+    try:
+        query = select_fields(model, fields, pk, encoder).order_by(pk)
+        if after is not None:
+            query = query.where(pk > after)
+        if limit is not None:
+            # Fetch one more row to find out if there is another page
+            query = query.limit(limit + 1)
+        if encoder or fields:
+            rows = db.session.execute(query).all()
+        else:
+            rows = db.session.execute(query).scalars().all()
+        if encoder:
+            response = json_response(
+                encoder.encode(encoder.dicts(rows[:limit])))
+        else:
+            try:
+                response = make_response(schema.dump(rows[:limit]))
+            except ValidationError as e:
+                app.logger.error(f"A Marshmallow ValidationError occurred dumping all {name}: {str(e)}")
+                msg = {'message': "An Internal Server Error occurred."}
+                return make_response(msg, 500)
+    except exc.SQLAlchemyError as e:
+        app.logger.error(f"An error occurred while fetching {name}: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    if limit is not None and len(rows) > limit:
+        set_next_page(response, getattr(rows[limit - 1], pk.name))
+    return response
+
+
+def stream_resource(model, schema, name, fields, after, limit, stream):
+    """Streams the rows of a table as NDJSON or as a JSON array.
+
+    The rows are fetched from the database in batches of STREAM_BATCH_SIZE
+    and each batch is encoded and sent before the next is fetched, so the
+    whole table is never held in memory. 'after' and 'limit' set where the
+    stream starts and the most rows it returns, but no next page cursor is
+    sent.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema used to dump many rows
+        name: The name of the rows used in log messages
+        fields: Optional tuple of the fields to return
+        after: Optional primary key to start after
+        limit: Optional maximum number of rows
+        stream: "ndjson" or "json"
+
+    Returns:
+        A streamed response, or 500 if the query fails
+    """
+    pk = inspect(model).primary_key[0]
+    encoder = fast_encoder(model, schema, fields)
+    query = select_fields(model, fields, pk, encoder).order_by(pk)
+    if after is not None:
+        query = query.where(pk > after)
+    if limit is not None:
+        query = query.limit(limit)
+    query = query.execution_options(yield_per=app.config["STREAM_BATCH_SIZE"])
+    # The stream outlives the request's session, so it uses its own
+    session = db.session.session_factory()
+    try:
+        # Run the query before the response starts so errors can be reported
+        result = session.execute(query)
+    except exc.SQLAlchemyError as e:
+        session.close()
+        app.logger.error(f"An error occurred while fetching {name}: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+
+    if encoder:
+        def encode_row(row):
+            return dumps(encoder.row_dict(row))
+    else:
+        row_schema = item_schema(schema, fields)
+        if not fields:
+            result = result.scalars()
+
+        def encode_row(row):
+            return dumps(row_schema.dump(row), sort_keys=True)
+
+    def generate():
+        try:
+            yield from stream_rows(result.partitions(), encode_row,
+                                   stream == "ndjson")
+        finally:
+            session.close()
+
+    mimetype = "application/x-ndjson" if stream == "ndjson" \
+        else "application/json"
+    return app.response_class(stream_with_context(generate()),
+                              mimetype=mimetype)
+
+
+def get_resource(model, schema, id, name):
+    """ Returns one row of a table in JSON.
+
+    If the 'fields' query parameter is given only those columns are
+    selected and returned.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema used to dump one row
+        id (int): The primary key of the row
+        name: The name of the row used in messages
+
+    Returns:
+        JSON for the row if found, 400 if the fields are not valid
+    """
+    pk = inspect(model).primary_key[0]
+    fields = field_args(model.__table__.c)
+    table = snapshot_table(model)
+    if table is not None:
+        encoder = get_encoder(model, type(schema), fields)
+        return json_response(encoder.encode(table.get(encoder.keys, id) or {}))
+    encoder = fast_encoder(model, schema, fields)
+    try:
+        query = select_fields(model, fields, pk, encoder).where(pk == id)
+        if encoder:
+            row = db.session.execute(query).one_or_none()
+            return json_response(encoder.encode(
+                encoder.row_dict(row) if row else {}))
+        if fields:
+            row = db.session.execute(query).one_or_none()
+            return projection_schema(schema, fields).dump(row)
+        row = db.session.execute(query).scalar_one_or_none()
+        return schema.dump(row)
+    except exc.NoResultFound as e:
+        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
+        app.logger.error(f'{name} {id} was not found. Error: {e}')
+        abort(404, description=f"{name} not found")
+
+
+def get_resources(model, schema, ids, name, fields=None):
+    """Returns the rows of a table with the given primary keys in JSON.
+
+    The rows are found with a single query and returned in the order of
+    ids. An id that is not found gets a marker in its place, e.g.
+    {"teacher_id": 9, "message": "Not found."}.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema used to dump many rows
+        ids: list of int primary keys
+        name: The name of the rows used in log messages
+        fields: Optional tuple of the fields to return
+
+    Returns:
+        JSON list of the rows, or 500 if there is a database or schema error
+    """
+    pk = inspect(model).primary_key[0]
+    table = snapshot_table(model)
+    encoder = get_encoder(model, type(schema), fields) if table is not None \
+        else fast_encoder(model, schema, fields)
+    if table is not None:
+        found = table.find(encoder.keys, ids)
+    else:
+        try:
+            query = select_fields(model, fields, pk, encoder) \
+                .where(pk.in_(set(ids)))
+            if encoder or fields:
+                rows = db.session.execute(query).all()
+            else:
+                rows = db.session.execute(query).scalars().all()
+        except exc.SQLAlchemyError as e:
+            app.logger.error(
+                f"An error occurred while fetching {name}: {str(e)}")
+            msg = {'message': "An Internal Server Error occurred."}
+            return make_response(msg, 500)
+        if encoder:
+            dumped = encoder.dicts(rows)
+        else:
+            if fields:
+                schema = projection_schema(schema, fields)
+            try:
+                dumped = schema.dump(rows)
+            except ValidationError as e:
+                app.logger.error(f"A Marshmallow ValidationError occurred dumping {name}: {str(e)}")
+                msg = {'message': "An Internal Server Error occurred."}
+                return make_response(msg, 500)
+        found = {getattr(row, pk.name): item
+                 for row, item in zip(rows, dumped)}
+    items = [found.get(id) or {pk.name: id, 'message': "Not found."}
+             for id in ids]
+    if encoder:
+        return json_response(encoder.encode(items))
+    return make_response(items)
+
+
+def upsert_statement(model):
+    """Returns an INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement.
+
+    A row with the primary key of an existing row replaces it. The
+    statement returns the primary key of each row written, in the order of
+    the parameters, so a single row is added and its id read back in one
+    statement.
+
+    Args:
+        model: The model class of the table
+    """
+    pk = inspect(model).primary_key[0]
+    statement = insert(model)
+    return statement.on_conflict_do_update(
+        index_elements=[pk],
+        set_={column.name: statement.excluded[column.name]
+              for column in model.__table__.c if column is not pk}) \
+        .returning(pk, sort_by_parameter_order=True)
+
+
+def add_resources(model, schema, items, name):
+    """Adds many rows from the items of a bulk request.
+
+    All the items are validated in one pass and the valid ones are written
+    with a single executemany INSERT ... RETURNING and one commit. If a
+    valid item breaks a constraint, e.g. the primary key of an existing row
+    or a unique email, the items are written one at a time in savepoints to
+    find which ones fail. Existing rows are never changed.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema used to load one row
+        items: list of the items in the request, None for an NDJSON line
+            that is not valid JSON
+        name: The name of the rows used in messages
+
+    Returns:
+        JSON list with a result for each item, in the same order, with its
+        'status' and either its primary key and a message or its errors.
+        The status code is 200 if every item was added, 400 if none were or
+        207 if some were. 500 if there is a database error.
+    """
+    pk = inspect(model).primary_key[0]
+    try:
+        rows = bulk_schema(type(schema)).load(items)
+        errors = {}
+    except ValidationError as e:
+        rows, errors = e.valid_data, e.messages
+    for index, item in enumerate(items):
+        if item is None:
+            errors[index] = {'_schema': ["Invalid JSON."]}
+    valid = [index for index in range(len(items)) if index not in errors]
+
+    statement = insert(model).returning(pk, sort_by_parameter_order=True)
+    ids = {}
+    try:
+        if valid:
+            try:
+                ids = dict(zip(valid, db.session.scalars(
+                    statement, [rows[index] for index in valid])))
+            except exc.IntegrityError:
+                db.session.rollback()
+                for index in valid:
+                    try:
+                        with db.session.begin_nested():
+                            ids[index] = db.session.scalar(
+                                statement, rows[index])
+                    except exc.IntegrityError as e:
+                        app.logger.error(f"An error occurred saving {name} {index}: {str(e)}")
+                        errors[index] = {'_schema': [
+                            "Conflicts with an existing row."]}
+            db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"An error occurred saving the {name}s: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+
+    results = []
+    for index in range(len(items)):
+        if index in ids:
+            results.append({'status': 200, pk.name: ids[index],
+                            'message': f"{name} added with id= {ids[index]}"})
+        else:
+            results.append({'status': 400, 'errors': errors[index]})
+    status = 200 if not errors else 400 if not ids else 207
+    return make_response(results, status)
+
+
+def delete_resources(model, name, dependents=(), keep=()):
+    """Deletes the rows of a table that match the request's filters.
+
+    The rows to delete are given by the 'ids' query parameter, e.g.
+    ?ids=1,5,9, and/or filters on any of the table's columns, e.g.
+    ?time_period=201718, as for /Records. They are deleted with one DELETE
+    statement in one transaction. At least one filter must be given so that
+    a table cannot be emptied by mistake.
+
+    Args:
+        model: The model class of the table
+        name: The name of the rows used in messages
+        dependents: Foreign key attributes, e.g. Refresh_token.user_id, of
+            rows that are deleted with the rows they refer to, in the same
+            transaction
+        keep: Foreign key attributes, e.g. Feedback.user_id, of rows that
+            stop the rows they refer to from being deleted
+
+    Returns:
+        JSON message with the number of rows deleted in 'deleted', 400 if
+        no filter is given or the filters are invalid, 500 if there is a
+        database error
+    """
+    pk = inspect(model).primary_key[0]
+    conditions = filter_args(dict(model.__table__.c.items()))
+    ids = id_args()
+    if ids is not None:
+        conditions.append(pk.in_(ids))
+    if not conditions:
+        abort(400, description="Give 'ids' or a column to filter on.")
+    conditions += [~db.exists().where(column == pk) for column in keep]
+    try:
+        for column in dependents:
+            db.session.execute(db.delete(column.class_).where(
+                column.in_(db.select(pk).where(*conditions))))
+        result = db.session.execute(db.delete(model).where(*conditions))
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"An error occurred deleting {name}: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return {"message": f"Deleted {result.rowcount} {name}.",
+            "deleted": result.rowcount}
+
+
+def select_fields(model, fields, pk, encoder=None):
+    """Returns a select of the whole model, or of only the given columns.
+
+    With an encoder, the columns are selected in the encoder's order. The
+    primary key is always selected so that it can be used for paging.
+    """
+    if encoder:
+        return db.select(*dict.fromkeys(encoder.columns + (pk,)))
+    if not fields:
+        return db.select(model)
+    columns = model.__table__.c
+    return db.select(*dict.fromkeys(
+        [columns[field] for field in fields] + [pk]))
+
+
+def json_response(body):
+    """Returns a response for an already encoded JSON body."""
+    return app.response_class(body, mimetype="application/json")
+
+
 # Route for the home page
 @app.route('/')
 def hello():
@@ -41,52 +457,35 @@ def hello():
 
 # Routes for User in GET, POST, DELETE and PATCH
 @app.get("/Users")
+@conditional_get(User, Feedback)
 def get_Users():
     """Returns a list of user_id and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the users, or 500 error if not found
     """
-    try:
-        # Select all the users using Flask-SQLAlchemy
-        all_users = db.session.execute(db.select(User)).scalars()
-        # Dump the data using the Marshmallow users schema; '.dump()' returns JSON.
-        try:
-            result = Users_schema.dump(all_users)
-            # If all OK then return the data in the HTTP response
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all users: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching users: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(User, Users_schema, "users")
 
 
 @app.get("/Users/<id>")
+@conditional_get(User, Feedback)
 def get_User(id):
     """ Returns one user in JSON.
 
     Returns 404 if the user_id is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The user_id of the user to be searched for
 
     Returns:
         JSON for the user if found otherwise 404
     """
-    # Try to find the user, if it is ot found, catch the error and return 404
-    try:
-        user = db.session.execute(
-            db.select(User).filter_by(user_id=id)
-        ).scalar_one_or_none()
-        return User_schema.dump(user)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'User {id} was not found. Error: {e}')
-        abort(404, description="User not found")
+    return get_resource(User, User_schema, id, "User")
 
 
 @app.post('/Users')
@@ -96,18 +495,24 @@ def add_User():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
    User_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'user added with user_id= {user.user_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(User, User_schema, items, "User")
     json_data = request.get_json()
     try:
-        user = User_schema.load(json_data)
+        user = row_schema(UserSchema).load(json_data)
 
         try:
-            db.session.add(user)
+            user_id = db.session.scalar(upsert_statement(User), user)
             db.session.commit()
-            return {"message": f"User added with user_id= {user.user_id}"}
+            return {"message": f"User added with user_id= {user_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the User: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -119,23 +524,47 @@ def add_User():
         return make_response(msg, 400)
 
 
+@app.delete('/Users')
+def delete_Users():
+    """ Deletes the users with the given ids or column values.
+
+    e.g. DELETE /Users?ids=1,2,3 or
+    DELETE /Users?user_name=test_user, see delete_resources(). Users who
+    still have feedback are not deleted.
+
+    Returns:
+        JSON message with the number of users deleted
+    """
+    return delete_resources(User, "users",
+                            dependents=[Refresh_token.user_id],
+                            keep=[Feedback.user_id])
+
+
 @app.delete('/Users/<id>')
 def delete_User(id):
     """ Deletes the user with the given code.
 
+    The user's refresh tokens are deleted in the same transaction, so they
+    cannot be used by a new user that is given the same id. A user who
+    still has feedback is not deleted.
+
     Args:
         id (int): user_id of the user to delete
     Returns:
-        JSON If successful, return success message, other return 500 Internal Server Error
+        JSON If successful, return success message, otherwise return 404
     """
     try:
-        user = db.session.execute(
-            db.select(User).filter_by(user_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(user)
+        db.session.execute(
+            db.delete(Refresh_token).filter_by(user_id=id))
+        user_id = db.session.execute(
+            db.delete(User).filter_by(user_id=id)
+            .where(~db.exists().where(Feedback.user_id == User.user_id))
+            .returning(User.user_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"User deleted with id= {user.user_id}"}
+        return {"message": f"User deleted with id= {user_id}"}
     except exc.SQLAlchemyError as e:
+        db.session.rollback()
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
         # Report a 404 error to the user who made the request
@@ -159,29 +588,33 @@ def User_update(id):
             If all OK then return 200
     """
     app.logger.error(f"Started the patch")
-    # Find the user in the database
-    try:
-        existing_user = db.session.execute(
-            db.select(User).filter_by(user_id=id)
-        ).scalar_one_or_none()
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
-        msg_content = f'User {id} not found'
-        msg = {'message': msg_content}
-        return make_response(msg, 404)
     # Get the updated details from the json sent in the HTTP patch request
     user_json = request.get_json()
     app.logger.error(f"user_json: {str(user_json)}")
-    # Use Marshmallow to update the existing records with the changes from the json
+    # Use Marshmallow to validate the changes from the json
     try:
-        user_update = User_schema.load(user_json, instance=existing_user, partial=True)
+        user_update = row_schema(UserSchema).load(user_json, partial=True)
     except ValidationError as e:
         app.logger.error(f"A Marshmallow schema validation error occurred: {str(e)}")
         msg = f'Failed Marshmallow schema validation'
         return make_response(msg, 500)
-    # Commit the changes to the database
+    # Update the user in the database, an empty update sets the id to itself
+    # so that a missing user is still found
     try:
-        db.session.add(user_update)
+        user_id = db.session.execute(
+            db.update(User).filter_by(user_id=id)
+            .values(user_update or {User.user_id: User.user_id})
+            .returning(User.user_id)
+        ).scalar_one_or_none()
+        if user_id is None:
+            msg_content = f'User {id} not found'
+            msg = {'message': msg_content}
+            return make_response(msg, 404)
+        # A new password ends the sessions started with the old one
+        if 'password_hash' in user_update:
+            db.session.execute(
+                db.update(Refresh_token).filter_by(user_id=user_id)
+                .values(revoked=True))
         db.session.commit()
         # Return json message
         response = {"message": f"User {id} updated."}
@@ -194,51 +627,35 @@ def User_update(id):
 
 # Routes for Feedback in GET, POST, DELETE and PATCH
 @app.get("/Feedbacks")
+@conditional_get(Feedback)
 def get_Feedbacks():
     """Returns a list of Feedbacks and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the Feedbacks, or 500 error if not found
     """
-    try:
-        # Select all the Feedbacks using Flask-SQLAlchemy
-        all_Feedback = db.session.execute(db.select(Feedback)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Feedbacks_schema.dump(all_Feedback)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all Feedbacks: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching Feedbacks: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Feedback, Feedbacks_schema, "Feedbacks")
 
 
 @app.get("/Feedbacks/<id>")
+@conditional_get(Feedback)
 def get_Feedback(id):
     """ Returns one feedback in JSON.
 
     Returns 404 if the feedback ID is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The ID of the feedback to be searched for
 
     Returns: 
         JSON for the feedback if found otherwise 404
     """
-    try:
-        feedback = db.session.execute(
-            db.select(Feedback).filter_by(feedback_id=id)
-        ).scalar_one_or_none()
-        return Feedback_schema.dump(feedback)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Feedback ID {id} was not found. Error: {e}')
-        abort(404, description="Feedback not found")
+    return get_resource(Feedback, Feedback_schema, id, "Feedback")
 
 
 @app.post('/Feedbacks')
@@ -248,18 +665,24 @@ def add_Feedback():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
     feedback_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Feedback added with feedback_id= {feedback.feedback_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Feedback, Feedback_schema, items, "Feedback")
     json_data = request.get_json()
     try:
-        feedback = Feedback_schema.load(json_data)
+        feedback = row_schema(FeedbackSchema).load(json_data)
 
         try:
-            db.session.add(feedback)
+            feedback_id = db.session.scalar(upsert_statement(Feedback), feedback)
             db.session.commit()
-            return {"message": f"Feedback added with feedback_id= {feedback.feedback_id}"}
+            return {"message": f"Feedback added with feedback_id= {feedback_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Feedback: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -271,6 +694,19 @@ def add_Feedback():
         return make_response(msg, 400)
 
 
+@app.delete('/Feedbacks')
+def delete_Feedbacks():
+    """ Deletes the feedbacks with the given ids or column values.
+
+    e.g. DELETE /Feedbacks?ids=1,2,3 or
+    DELETE /Feedbacks?user_id=3, see delete_resources().
+
+    Returns:
+        JSON message with the number of feedbacks deleted
+    """
+    return delete_resources(Feedback, "feedbacks")
+
+
 @app.delete('/Feedbacks/<id>')
 def delete_Feedback(id):
     """ Deletes the feedback with the given ID.
@@ -281,12 +717,12 @@ def delete_Feedback(id):
         JSON If successful, return success message, otherwise return 500 Internal Server Error
     """
     try:
-        feedback = db.session.execute(
-            db.select(Feedback).filter_by(feedback_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(feedback)
+        feedback_id = db.session.execute(
+            db.delete(Feedback).filter_by(feedback_id=id)
+            .returning(Feedback.feedback_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Feedback deleted with id= {feedback.feedback_id}"}
+        return {"message": f"Feedback deleted with id= {feedback_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -298,51 +734,35 @@ def delete_Feedback(id):
 
 # Routes for Age_group in GET, POST and DELETE
 @app.get("/Age_groups")
+@conditional_get(Age_group)
 def get_Age_groups():
     """Returns a list of Age_group codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the Age_groups, or 500 error if not found
     """
-    try:
-        # Select all the Age_groups using Flask-SQLAlchemy
-        all_Age_group = db.session.execute(db.select(Age_group)).scalars()
-        # Get the data using Marshmallow schema (returns JSON)
-        try:
-            result = Age_groups_schema.dump(all_Age_group)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all Age_groups: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching Age_groups: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Age_group, Age_groups_schema, "Age_groups")
 
 
 @app.get("/Age_groups/<id>")
+@conditional_get(Age_group)
 def get_Age_group(id):
     """ Returns one Age_group in JSON.
 
     Returns 404 if the Age_group code is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The ID of the Age_group to be searched for
 
     Returns: 
         JSON for the Age_group if found otherwise 404
     """
-    try:
-        age_group = db.session.execute(
-            db.select(Age_group).filter_by(age_group_id=id)
-        ).scalar_one_or_none()
-        return Age_group_schema.dump(age_group)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Age_group ID {id} was not found. Error: {e}')
-        abort(404, description="Age_group not found")
+    return get_resource(Age_group, Age_group_schema, id, "Age_group")
 
 
 @app.post('/Age_groups')
@@ -352,18 +772,24 @@ def add_Age_group():
     Gets the JSON data from the request body and uses this to deserialize JSON to an object using Marshmallow
     age_group_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Age_group added with age_group_id= {age_group.age_group_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Age_group, Age_group_schema, items, "Age_group")
     json_data = request.get_json()
     try:
-        age_group = Age_group_schema.load(json_data)
+        age_group = row_schema(Age_groupSchema).load(json_data)
 
         try:
-            db.session.add(age_group)
+            age_group_id = db.session.scalar(upsert_statement(Age_group), age_group)
             db.session.commit()
-            return {"message": f"Age_group added with age_group_id= {age_group.age_group_id}"}
+            return {"message": f"Age_group added with age_group_id= {age_group_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Age_group: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -375,6 +801,19 @@ def add_Age_group():
         return make_response(msg, 400)
 
 
+@app.delete('/Age_groups')
+def delete_Age_groups():
+    """ Deletes the age groups with the given ids or column values.
+
+    e.g. DELETE /Age_groups?ids=1,2,3 or
+    DELETE /Age_groups?time_period=201718, see delete_resources().
+
+    Returns:
+        JSON message with the number of age groups deleted
+    """
+    return delete_resources(Age_group, "age groups")
+
+
 @app.delete('/Age_groups/<id>')
 def delete_Age_group(id):
     """ Deletes the age group with the given id.
@@ -385,12 +824,12 @@ def delete_Age_group(id):
         JSON If successful, return success message, otherwise return 404 Not Found
     """
     try:
-        age_group = db.session.execute(
-            db.select(Age_group).filter_by(age_group_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(age_group)
+        age_group_id = db.session.execute(
+            db.delete(Age_group).filter_by(age_group_id=id)
+            .returning(Age_group.age_group_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Age_group deleted with id= {age_group.age_group_id}"}
+        return {"message": f"Age_group deleted with id= {age_group_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -402,51 +841,35 @@ def delete_Age_group(id):
 
 # Routes for Gender in GET, POST and DELETE
 @app.get("/Genders")
+@conditional_get(Gender)
 def get_Genders():
     """Returns a list of Gender codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the genders, or 500 error if not found
     """
-    try:
-        # Select all the genders using Flask-SQLAlchemy
-        all_Gender = db.session.execute(db.select(Gender)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Genders_schema.dump(all_Gender)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all genders: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching genders: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Gender, Genders_schema, "genders")
 
 
 @app.get("/Genders/<id>")
+@conditional_get(Gender)
 def get_Gender(id):
     """ Returns one gender in JSON.
 
     Returns 404 if the gender code is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the gender to be searched for
 
     Returns: 
         JSON for the gender if found otherwise 404
     """
-    try:
-        gender = db.session.execute(
-            db.select(Gender).filter_by(gender_id=id)
-        ).scalar_one_or_none()
-        return Gender_schema.dump(gender)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Gender id {id} was not found. Error: {e}')
-        abort(404, description="Gender not found")
+    return get_resource(Gender, Gender_schema, id, "Gender")
 
 
 @app.post('/Genders')
@@ -456,18 +879,24 @@ def add_Gender():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
     gender_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Gender added with gender_id= {gender.gender_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Gender, Gender_schema, items, "Gender")
     json_data = request.get_json()
     try:
-        gender = Gender_schema.load(json_data)
+        gender = row_schema(GenderSchema).load(json_data)
 
         try:
-            db.session.add(gender)
+            gender_id = db.session.scalar(upsert_statement(Gender), gender)
             db.session.commit()
-            return {"message": f"Gender added with gender_id= {gender.gender_id}"}
+            return {"message": f"Gender added with gender_id= {gender_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Gender: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -479,6 +908,19 @@ def add_Gender():
         return make_response(msg, 400)
 
 
+@app.delete('/Genders')
+def delete_Genders():
+    """ Deletes the genders with the given ids or column values.
+
+    e.g. DELETE /Genders?ids=1,2,3 or
+    DELETE /Genders?time_period=201718, see delete_resources().
+
+    Returns:
+        JSON message with the number of genders deleted
+    """
+    return delete_resources(Gender, "genders")
+
+
 @app.delete('/Genders/<id>')
 def delete_Gender(id):
     """ Deletes the gender with the given id.
@@ -490,12 +932,12 @@ def delete_Gender(id):
         or 500 Internal Server Error for database errors
     """
     try:
-        gender = db.session.execute(
-            db.select(Gender).filter_by(gender_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(gender)
+        gender_id = db.session.execute(
+            db.delete(Gender).filter_by(gender_id=id)
+            .returning(Gender.gender_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Gender deleted with id= {gender.gender_id}"}
+        return {"message": f"Gender deleted with id= {gender_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -507,51 +949,35 @@ def delete_Gender(id):
 
 # Routes for Ethnicity in GET, POST and DELETE
 @app.get("/Ethnicities")
+@conditional_get(Ethnicity)
 def get_Ethnicities():
     """Returns a list of Ethnicity codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the ethnicities, or 500 error if not found
     """
-    try:
-        # Select all the ethnicities using Flask-SQLAlchemy
-        all_ethnicities = db.session.execute(db.select(Ethnicity)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Ethnicities_schema.dump(all_ethnicities)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all ethnicities: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching ethnicities: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Ethnicity, Ethnicities_schema, "ethnicities")
 
 
 @app.get("/Ethnicities/<id>")
+@conditional_get(Ethnicity)
 def get_Ethnicity(id):
     """ Returns one ethnicity in JSON.
 
     Returns 404 if the ethnicity id is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the ethnicity to be searched for
 
     Returns: 
         JSON for the ethnicity if found otherwise 404
     """
-    try:
-        ethnicity = db.session.execute(
-            db.select(Ethnicity).filter_by(ethnicity_id=id)
-        ).scalar_one_or_none()
-        return Ethnicity_schema.dump(ethnicity)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Ethnicity id {id} was not found. Error: {e}')
-        abort(404, description="Ethnicity not found")
+    return get_resource(Ethnicity, Ethnicity_schema, id, "Ethnicity")
 
 
 @app.post('/Ethnicities')
@@ -561,18 +987,24 @@ def add_Ethnicity():
     Gets the JSON data from the request body and uses this to deserialize JSON to an object using Marshmallow
     ethnicity_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns:
         JSON message. If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Ethnicity added with ethnicity_id= {ethnicity.ethnicity_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Ethnicity, Ethnicity_schema, items, "Ethnicity")
     json_data = request.get_json()
     try:
-        ethnicity = Ethnicity_schema.load(json_data)
+        ethnicity = row_schema(EthnicitySchema).load(json_data)
 
         try:
-            db.session.add(ethnicity)
+            ethnicity_id = db.session.scalar(upsert_statement(Ethnicity), ethnicity)
             db.session.commit()
-            return {"message": f"Ethnicity added with ethnicity_id= {ethnicity.ethnicity_id}"}
+            return {"message": f"Ethnicity added with ethnicity_id= {ethnicity_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Ethnicity: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -584,6 +1016,19 @@ def add_Ethnicity():
         return make_response(msg, 400)
 
 
+@app.delete('/Ethnicities')
+def delete_Ethnicities():
+    """ Deletes the ethnicities with the given ids or column values.
+
+    e.g. DELETE /Ethnicities?ids=1,2,3 or
+    DELETE /Ethnicities?time_period=201718, see delete_resources().
+
+    Returns:
+        JSON message with the number of ethnicities deleted
+    """
+    return delete_resources(Ethnicity, "ethnicities")
+
+
 @app.delete('/Ethnicities/<id>')
 def delete_Ethnicity(id):
     """ Deletes the ethnicity with the given id.
@@ -595,12 +1040,12 @@ def delete_Ethnicity(id):
         or 500 Internal Server Error for database errors
     """
     try:
-        ethnicity = db.session.execute(
-            db.select(Ethnicity).filter_by(ethnicity_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(ethnicity)
+        ethnicity_id = db.session.execute(
+            db.delete(Ethnicity).filter_by(ethnicity_id=id)
+            .returning(Ethnicity.ethnicity_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Ethnicity deleted with id= {ethnicity.ethnicity_id}"}
+        return {"message": f"Ethnicity deleted with id= {ethnicity_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -612,51 +1057,35 @@ def delete_Ethnicity(id):
 
 # Routes for Employment in GET, POST and DELETE
 @app.get("/Employments")
+@conditional_get(Employment)
 def get_Employments():
     """Returns a list of Employment codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the employments, or 500 error if not found
     """
-    try:
-        # Select all the employments using Flask-SQLAlchemy
-        all_employments = db.session.execute(db.select(Employment)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Employments_schema.dump(all_employments)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all employments: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching employments: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Employment, Employments_schema, "employments")
 
 
 @app.get("/Employments/<id>")
+@conditional_get(Employment)
 def get_Employment(id):
     """ Returns one employment in JSON.
 
     Returns 404 if the employment id is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the employment to be searched for
 
     Returns: 
         JSON for the employment if found, otherwise 404
     """
-    try:
-        employment = db.session.execute(
-            db.select(Employment).filter_by(employment_id=id)
-        ).scalar_one_or_none()
-        return Employment_schema.dump(employment)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Employment id {id} was not found. Error: {e}')
-        abort(404, description="Employment not found")
+    return get_resource(Employment, Employment_schema, id, "Employment")
 
 
 @app.post('/Employments')
@@ -666,18 +1095,24 @@ def add_Employment():
     Gets the JSON data from the request body and uses this to deserialize JSON to an object using Marshmallow
     Employment_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message. If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Employment added with id= {employment.employment_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Employment, Employment_schema, items, "Employment")
     json_data = request.get_json()
     try:
-        employment = Employment_schema.load(json_data)
+        employment = row_schema(EmploymentSchema).load(json_data)
 
         try:
-            db.session.add(employment)
+            employment_id = db.session.scalar(upsert_statement(Employment), employment)
             db.session.commit()
-            return {"message": f"Employment added with id= {employment.employment_id}"}
+            return {"message": f"Employment added with id= {employment_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Employment: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -689,6 +1124,19 @@ def add_Employment():
         return make_response(msg, 400)
 
 
+@app.delete('/Employments')
+def delete_Employments():
+    """ Deletes the employments with the given ids or column values.
+
+    e.g. DELETE /Employments?ids=1,2,3 or
+    DELETE /Employments?employment_status=Teaching, see delete_resources().
+
+    Returns:
+        JSON message with the number of employments deleted
+    """
+    return delete_resources(Employment, "employments")
+
+
 @app.delete('/Employments/<id>')
 def delete_Employment(id):
     """ Deletes the employment with the given id.
@@ -699,12 +1147,12 @@ def delete_Employment(id):
         JSON If successful, return success message, otherwise return 404 if employment not found or 500 Internal Server Error
     """
     try:
-        employment = db.session.execute(
-            db.select(Employment).filter_by(employment_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(employment)
+        employment_id = db.session.execute(
+            db.delete(Employment).filter_by(employment_id=id)
+            .returning(Employment.employment_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Employment deleted with id= {employment.employment_id}"}
+        return {"message": f"Employment deleted with id= {employment_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -716,51 +1164,35 @@ def delete_Employment(id):
 
 # Routes for Course_level in GET, POST and DELETE
 @app.get("/Course_levels")
+@conditional_get(Course_level)
 def get_Course_levels():
     """Returns a list of course levels and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the course levels, or 500 error if not found
     """
-    try:
-        # Select all the course levels using Flask-SQLAlchemy
-        all_course_levels = db.session.execute(db.select(Course_level)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Course_levels_schema.dump(all_course_levels)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all course levels: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching course levels: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Course_level, Course_levels_schema, "course levels")
 
 
 @app.get("/Course_levels/<id>")
+@conditional_get(Course_level)
 def get_Course_level(id):
     """ Returns one course level in JSON.
 
     Returns 404 if the course level code is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the course level to be searched for
 
     Returns: 
         JSON for the course level if found otherwise 404
     """
-    try:
-        course_level = db.session.execute(
-            db.select(Course_level).filter_by(course_level_id=id)
-        ).scalar_one_or_none()
-        return Course_level_schema.dump(course_level)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Course level code {id} was not found. Error: {e}')
-        abort(404, description="Course level not found")
+    return get_resource(Course_level, Course_level_schema, id, "Course level")
 
 
 @app.post('/Course_levels')
@@ -770,18 +1202,24 @@ def add_Course_level():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
     course_level_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Course level added with id= {course_level.course_level_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Course_level, Course_level_schema, items, "Course_level")
     json_data = request.get_json()
     try:
-        course_level = Course_level_schema.load(json_data)
+        course_level = row_schema(Course_levelSchema).load(json_data)
 
         try:
-            db.session.add(course_level)
+            course_level_id = db.session.scalar(upsert_statement(Course_level), course_level)
             db.session.commit()
-            return {"message": f"Course level added with id= {course_level.course_level_id}"}
+            return {"message": f"Course level added with id= {course_level_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Course level: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -793,6 +1231,20 @@ def add_Course_level():
         return make_response(msg, 400)
 
 
+@app.delete('/Course_levels')
+def delete_Course_levels():
+    """ Deletes the course levels with the given ids or column values.
+
+    e.g. DELETE /Course_levels?ids=1,2,3 or
+    DELETE /Course_levels?course_level_recoded=Undergraduate, see
+    delete_resources().
+
+    Returns:
+        JSON message with the number of course levels deleted
+    """
+    return delete_resources(Course_level, "course levels")
+
+
 @app.delete('/Course_levels/<id>')
 def delete_Course_level(id):
     """ Deletes the course level with the given id.
@@ -804,12 +1256,12 @@ def delete_Course_level(id):
         or 500 Internal Server Error for other errors
     """
     try:
-        course_level = db.session.execute(
-            db.select(Course_level).filter_by(course_level_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(course_level)
+        course_level_id = db.session.execute(
+            db.delete(Course_level).filter_by(course_level_id=id)
+            .returning(Course_level.course_level_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Course_level deleted with id= {course_level.course_level_id}"}
+        return {"message": f"Course_level deleted with id= {course_level_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -821,51 +1273,35 @@ def delete_Course_level(id):
 
 # Routes for Disability in GET, POST and DELETE
 @app.get("/Disabilities")
+@conditional_get(Disability)
 def get_Disabilities():
     """Returns a list of Disability codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the disabilities, or 500 error if not found
     """
-    try:
-        # Select all the disabilities using Flask-SQLAlchemy
-        all_Disability = db.session.execute(db.select(Disability)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Disabilities_schema.dump(all_Disability)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all disabilities: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching disabilities: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Disability, Disabilities_schema, "disabilities")
 
 
 @app.get("/Disabilities/<id>")
+@conditional_get(Disability)
 def get_Disability(id):
     """ Returns one disability in JSON.
 
     Returns 404 if the disability id is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the disability to be searched for
 
     Returns: 
         JSON for the disability if found otherwise 404
     """
-    try:
-        disability = db.session.execute(
-            db.select(Disability).filter_by(disability_id=id)
-        ).scalar_one_or_none()
-        return Disability_schema.dump(disability)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Disability id {id} was not found. Error: {e}')
-        abort(404, description="Disability not found")
+    return get_resource(Disability, Disability_schema, id, "Disability")
 
 
 @app.post('/Disabilities')
@@ -875,18 +1311,24 @@ def add_Disability():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
     disability_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Disability added with id= {disability.disability_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Disability, Disability_schema, items, "Disability")
     json_data = request.get_json()
     try:
-        disability = Disability_schema.load(json_data)
+        disability = row_schema(DisabilitySchema).load(json_data)
 
         try:
-            db.session.add(disability)
+            disability_id = db.session.scalar(upsert_statement(Disability), disability)
             db.session.commit()
-            return {"message": f"Disability added with id= {disability.disability_id}"}
+            return {"message": f"Disability added with id= {disability_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Disability: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -898,6 +1340,19 @@ def add_Disability():
         return make_response(msg, 400)
 
 
+@app.delete('/Disabilities')
+def delete_Disabilities():
+    """ Deletes the disabilities with the given ids or column values.
+
+    e.g. DELETE /Disabilities?ids=1,2,3 or
+    DELETE /Disabilities?time_period=201718, see delete_resources().
+
+    Returns:
+        JSON message with the number of disabilities deleted
+    """
+    return delete_resources(Disability, "disabilities")
+
+
 @app.delete('/Disabilities/<id>')
 def delete_Disability(id):
     """ Deletes the disability with the given id.
@@ -909,12 +1364,12 @@ def delete_Disability(id):
         or 500 Internal Server Error for database errors
     """
     try:
-        disability = db.session.execute(
-            db.select(Disability).filter_by(disability_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(disability)
+        disability_id = db.session.execute(
+            db.delete(Disability).filter_by(disability_id=id)
+            .returning(Disability.disability_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Disability deleted with id= {disability.disability_id}"}
+        return {"message": f"Disability deleted with id= {disability_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -926,51 +1381,35 @@ def delete_Disability(id):
 
 # Routes for Teacher in GET, POST, DELETE and PATCH
 @app.get("/Teachers")
+@conditional_get(Teacher)
 def get_Teachers():
     """Returns a list of Teacher codes and their details in JSON.
 
+    Supports keyset pagination with the 'limit' and 'after' query
+    parameters, see list_resource().
+
     Returns:
         JSON for all the teachers, or 500 error if not found
     """
-    try:
-        # Select all the teachers using Flask-SQLAlchemy
-        all_Teacher = db.session.execute(db.select(Teacher)).scalars()
-        try:
-            # Get the data using Marshmallow schema (returns JSON)
-            result = Teachers_schema.dump(all_Teacher)
-            # Return the data
-            return result
-        except ValidationError as e:
-            app.logger.error(f"A Marshmallow ValidationError occurred dumping all teachers: {str(e)}")
-            msg = {'message': "An Internal Server Error occurred."}
-            return make_response(msg, 500)
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"An error occurred while fetching teachers: {str(e)}")
-        msg = {'message': "An Internal Server Error occurred."}
-        return make_response(msg, 500)
+    return list_resource(Teacher, Teachers_schema, "teachers")
 
 
 @app.get("/Teachers/<id>")
+@conditional_get(Teacher)
 def get_Teacher(id):
     """ Returns one teacher in JSON.
 
     Returns 404 if the teacher id is not found in the database.
 
+    Supports the 'fields' query parameter, see get_resource().
+
     Args:
         id (int): The id of the teacher to be searched for
 
     Returns: 
         JSON for the teacher if found, otherwise 404
     """
-    try:
-        teacher = db.session.execute(
-            db.select(Teacher).filter_by(teacher_id=id)
-        ).scalar_one_or_none()
-        return Teacher_schema.dump(teacher)
-    except exc.NoResultFound as e:
-        # See https://flask.palletsprojects.com/en/2.3.x/errorhandling/#returning-api-errors-as-json
-        app.logger.error(f'Teacher with id {id} was not found. Error: {e}')
-        abort(404, description="Teacher not found")
+    return get_resource(Teacher, Teacher_schema, id, "Teacher")
 
 
 @app.post('/Teachers')
@@ -980,18 +1419,24 @@ def add_Teacher():
     Gets the JSON data from the request body and uses this to deserialise JSON to an object using Marshmallow
     teacher_schema.loads()
 
+    A JSON array, or an NDJSON body, of many items adds them all in one
+    statement, see add_resources().
+
     Returns: 
         JSON message  If there is an error, return 400 if the issue is with the validation, 500 if there is a
         database issue, otherwise return message 'Teacher added with id= {teacher.teacher_id}'
     """
+    items = bulk_items()
+    if items is not None:
+        return add_resources(Teacher, Teacher_schema, items, "Teacher")
     json_data = request.get_json()
     try:
-        teacher = Teacher_schema.load(json_data)
+        teacher = row_schema(TeacherSchema).load(json_data)
 
         try:
-            db.session.add(teacher)
+            teacher_id = db.session.scalar(upsert_statement(Teacher), teacher)
             db.session.commit()
-            return {"message": f"Teacher added with id= {teacher.teacher_id}"}
+            return {"message": f"Teacher added with id= {teacher_id}"}
         except exc.SQLAlchemyError as e:
             app.logger.error(f"An error occurred saving the Teacher: {str(e)}")
             msg = {'message': "An Internal Server Error occurred."}
@@ -1003,6 +1448,19 @@ def add_Teacher():
         return make_response(msg, 400)
 
 
+@app.delete('/Teachers')
+def delete_Teachers():
+    """ Deletes the teachers with the given ids or column values.
+
+    e.g. DELETE /Teachers?ids=1,2,3 or
+    DELETE /Teachers?qts_status=Total, see delete_resources().
+
+    Returns:
+        JSON message with the number of teachers deleted
+    """
+    return delete_resources(Teacher, "teachers")
+
+
 @app.delete('/Teachers/<id>')
 def delete_Teacher(id):
     """ Deletes the teacher with the given id.
@@ -1013,12 +1471,12 @@ def delete_Teacher(id):
         JSON If successful, return success message, otherwise return 500 Internal Server Error
     """
     try:
-        teacher = db.session.execute(
-            db.select(Teacher).filter_by(teacher_id=id)
-        ).scalar_one_or_none()
-        db.session.delete(teacher)
+        teacher_id = db.session.execute(
+            db.delete(Teacher).filter_by(teacher_id=id)
+            .returning(Teacher.teacher_id)
+        ).scalar_one()
         db.session.commit()
-        return {"message": f"Teacher deleted with id= {teacher.teacher_id}"}
+        return {"message": f"Teacher deleted with id= {teacher_id}"}
     except exc.SQLAlchemyError as e:
         # Log the exception with the error
         app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
@@ -1045,29 +1503,28 @@ def Teacher_update(id):
             If all OK then return 200
     """
     app.logger.error(f"Started the patch")
-    # Find the teacher in the database
-    try:
-        existing_teacher = db.session.execute(
-            db.select(Teacher).filter_by(teacher_id=id)
-        ).scalar_one_or_none()
-    except exc.SQLAlchemyError as e:
-        app.logger.error(f"A SQLAlchemy database error occurred: {str(e)}")
-        msg_content = f'Teacher {id} not found'
-        msg = {'message': msg_content}
-        return make_response(msg, 404)
     # Get the updated details from the json sent in the HTTP patch request
     teacher_json = request.get_json()
     app.logger.error(f"teacher_json: {str(teacher_json)}")
-    # Use Marshmallow to update the existing records with the changes from the json
+    # Use Marshmallow to validate the changes from the json
     try:
-        teacher_update = Teacher_schema.load(teacher_json, instance=existing_teacher, partial=True)
+        teacher_update = row_schema(TeacherSchema).load(teacher_json, partial=True)
     except ValidationError as e:
         app.logger.error(f"A Marshmallow schema validation error occurred: {str(e)}")
         msg = f'Failed Marshmallow schema validation'
         return make_response(msg, 500)
-    # Commit the changes to the database
+    # Update the teacher in the database, an empty update sets the id to itself
+    # so that a missing teacher is still found
     try:
-        db.session.add(teacher_update)
+        teacher_id = db.session.execute(
+            db.update(Teacher).filter_by(teacher_id=id)
+            .values(teacher_update or {Teacher.teacher_id: Teacher.teacher_id})
+            .returning(Teacher.teacher_id)
+        ).scalar_one_or_none()
+        if teacher_id is None:
+            msg_content = f'Teacher {id} not found'
+            msg = {'message': msg_content}
+            return make_response(msg, 404)
         db.session.commit()
         # Return json message
         response = {"message": f"Teacher {id} updated."}
@@ -1078,6 +1535,202 @@ def Teacher_update(id):
         return make_response(msg, 500)
 
 
+# Route for the joined records of all the tables in GET
+@app.get("/Records")
+@conditional_get(*RECORD_MODELS)
+def get_Records():
+    """Returns the original rows of the dataset in JSON.
+
+    Each record joins the rows with the same id in the teacher,
+    course_level, employment, age_group, gender, ethnicity and
+    disability_group tables in a single query, with the teacher_id as its
+    record_id.
+
+    Records can be filtered on time_period, course_level_recoded,
+    qts_status and employment_status, repeating a parameter to match any of
+    its values, e.g. ?qts_status=Awarded%20QTS&time_period=201819. Supports
+    the 'fields' query parameter and keyset pagination on the record_id with
+    'limit' and 'after', see list_resource(). The records are read from the
+    app's snapshot if it has one.
+
+    Returns:
+        JSON for the records, 400 if the parameters are invalid or 500 if
+        there is a database error
+    """
+    columns = record_columns()
+    after, limit = page_args()
+    fields = field_args(columns)
+    dimensions = {name: columns[name] for name in DIMENSIONS}
+    encoder = record_encoder(fields)
+    store = current_store()
+    if store:
+        records = store.records(db.session)
+        positions, last = find_records(records, filter_values(dimensions),
+                                       after, limit)
+        response = json_response(encoder.encode(
+            record_dicts(records, encoder.keys, positions)))
+        if last is not None:
+            set_next_page(response, last)
+        return response
+    conditions = filter_args(dimensions)
+    pk = columns['record_id']
+    query = select_records(*dict.fromkeys(encoder.columns + (pk,))) \
+        .where(*conditions).order_by(pk)
+    if after is not None:
+        query = query.where(pk > after)
+    if limit is not None:
+        # Fetch one more row to find out if there is another page
+        query = query.limit(limit + 1)
+    try:
+        rows = db.session.execute(query).all()
+    except exc.SQLAlchemyError as e:
+        app.logger.error(f"An error occurred while fetching records: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    response = json_response(encoder.encode(encoder.dicts(rows[:limit])))
+    if limit is not None and len(rows) > limit:
+        set_next_page(response, rows[limit - 1].teacher_id)
+    return response
+
+
+# Route for aggregates of the records in GET
+@app.get("/aggregate")
+@conditional_get(*RECORD_MODELS)
+def get_aggregate():
+    """Returns the sum, count and weighted means of the records by group.
+
+    The records are grouped by the dimensions in the 'group_by' query
+    parameter, e.g. ?group_by=time_period,qts_status, and the aggregation is
+    done in one SQL query. Each group has its group_by values, the sum of
+    n_total, the count of records and the mean of each pct_ column weighted
+    by n_total, see aggregate_encoder().
+
+    The records can be filtered as for /Records. The dataset includes the
+    'Total' rows that sum the other rows, so filter on the dimensions that
+    are not grouped by to avoid counting rows twice, e.g.
+    ?group_by=time_period&qts_status=Total&course_level_recoded=Total
+
+    With a snapshot the aggregation is done with NumPy on its records, see
+    aggregate_records().
+
+    Returns:
+        JSON list of the groups, 400 if the parameters are invalid or 500 if
+        there is a database error
+    """
+    columns = record_columns()
+    group_by = group_args(DIMENSIONS)
+    dimensions = {name: columns[name] for name in DIMENSIONS}
+    encoder = aggregate_encoder(group_by)
+    store = current_store()
+    if store:
+        records = store.records(db.session)
+        positions, _ = find_records(records, filter_values(dimensions))
+        return json_response(encoder.encode(
+            aggregate_records(records, group_by, positions)))
+    conditions = filter_args(dimensions)
+    try:
+        rows = db.session.execute(
+            select_aggregates(group_by).where(*conditions)).all()
+    except exc.SQLAlchemyError as e:
+        app.logger.error(
+            f"An error occurred while aggregating records: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return json_response(encoder.encode(encoder.dicts(rows)))
+
+
+# Route for the precomputed cube of aggregates in GET
+@app.get("/cube")
+@conditional_get(Cube_cell)
+def get_cube():
+    """Returns cells of the cube of aggregates in JSON.
+
+    The cube holds the n_total, count and weighted means of the records for
+    every combination of time_period, course_level_recoded, qts_status and
+    employment_status in the data, plus a time_period of 'Total' for all
+    the years of each combination. It is kept up to date as records are
+    written, so giving all four dimensions is a primary key lookup, e.g.
+    ?time_period=Total&course_level_recoded=Postgraduate&qts_status=Total
+    &employment_status=Total. Repeat a parameter to match any of its values.
+
+    Returns:
+        JSON list of the matching cells, 400 if the parameters are invalid
+        or 500 if there is a database error
+    """
+    columns = Cube_cell.__table__.c
+    conditions = filter_args({name: columns[name] for name in DIMENSIONS})
+    encoder = cube_encoder()
+    try:
+        rows = db.session.execute(
+            db.select(*encoder.columns).where(*conditions)
+            .order_by(*Cube_cell.__table__.primary_key)).all()
+    except exc.SQLAlchemyError as e:
+        app.logger.error(f"An error occurred while fetching the cube: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return json_response(encoder.encode(encoder.dicts(rows)))
+
+
+# Route for the trends of the series in GET
+@app.get("/trends/<metric>")
+@conditional_get(*RECORD_MODELS)
+def get_trends(metric):
+    """Returns the year over year trend of a metric for every series.
+
+    A series is a course_level_recoded, qts_status and employment_status.
+    For each time period the value, the change and percentage change from
+    the previous time period are returned, and the compound annual growth
+    rate over the series, see compute_trends(). The trends are computed
+    with NumPy from a columnar copy of the records that is only read again
+    after the record tables change, the app's snapshot if it has one.
+
+    Args:
+        metric: n_total or one of the pct_ fields of a record
+
+    Returns:
+        JSON list of the trend of each series, 404 if the metric is not
+        known or 500 if there is a database error
+    """
+    if metric not in metrics():
+        abort(404, description=f"Unknown metric {metric}.")
+    try:
+        store = current_store()
+        records = store.records(db.session) if store \
+            else load_records(db.session)
+    except exc.SQLAlchemyError as e:
+        app.logger.error(f"An error occurred while fetching records: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return json_response(
+        dumps(compute_trends(records, metric), sort_keys=True) + b"\n")
+
+
+@app.post("/batch")
+def batch():
+    """Runs several requests to the API and returns all their responses.
+
+    The body is a JSON array of sub-requests, each an object with the
+    'method' (default GET) and 'path', with any query string, and
+    optionally a JSON 'body' and an object of 'headers'. Sub-requests are
+    sent with the Authorization and Accept headers of the batch request.
+    They run in order, except that consecutive GET sub-requests run at the
+    same time. See src.batch.run_batch().
+
+    Returns:
+        JSON list with the 'status', 'headers' and 'body' of the response
+        to each sub-request, in the same order. 400 if the body is not a
+        list or has more than BATCH_MAX_REQUESTS sub-requests.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        msg = {'message': "The body must be a JSON array of sub-requests."}
+        return make_response(msg, 400)
+    if len(items) > app.config['BATCH_MAX_REQUESTS']:
+        msg = {'message': f"A batch may have at most {app.config['BATCH_MAX_REQUESTS']} sub-requests."}
+        return make_response(msg, 400)
+    return jsonify(run_batch(items))
+
+
 # AUTHENTICATION ROUTES
 @app.post("/register")
 def register():
@@ -1085,6 +1738,7 @@ def register():
 
     If successful, return 201 Created.
     If email already exists, return 409 Conflict (resource already exists).
+    If the password cannot be hashed because the server is busy, return 503
     If any other error occurs, return 500 Server error
     """
     # Get the JSON data from the request
@@ -1128,7 +1782,9 @@ def login():
 
     If the email and password are not present in the HTTP request, return 401 error
     If the user is not found in the database, or the password is incorrect, return 401 error
-    If the user is logged in and the token is generated, return the token and 201 Success
+    If the user is logged in and the token is generated, return the token, a
+    refresh token and 201 Success
+    If the password cannot be checked because the server is busy, return 503 error
     """
     auth = request.get_json()
 
@@ -1147,8 +1803,83 @@ def login():
         msg = {'message': 'Incorrect email or password.'}
         return make_response(msg, 401)
 
-    # If all OK then create the token
-    token = encode_auth_token(user.user_id)
+    # Rehash the password if the hash parameters have changed since it was
+    # stored, it is saved with the refresh token
+    if user.password_needs_rehash():
+        user.set_password(auth.get('password'))
+
+    # If all OK then create the token, and a refresh token that gets new
+    # tokens from /token/refresh without the password
+    user_id = user.user_id
+    token = encode_auth_token(user_id)
+    try:
+        refresh_token = issue_refresh_token(user_id)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"An error occurred saving the refresh token: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+
+    # Return the tokens and the user_id of the logged in user
+    return make_response(jsonify({"user_id": user_id, "token": token,
+                                  "refresh_token": refresh_token}), 201)
+
+
+@app.post('/token/refresh')
+def refresh_token():
+    """Issues a new token, and a new refresh token, for a refresh token
+
+    The refresh token can only be used once, the new refresh token replaces
+    it. The password is not checked, so this is much cheaper than /login.
+
+    If the refresh token is missing, return 401 error
+    If the refresh token is not valid, expired, revoked or already used,
+    return 401 error
+    If the tokens are generated, return them and 201 Success
+    """
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if not isinstance(token, str) or not token:
+        msg = {'message': 'Missing refresh token'}
+        return make_response(msg, 401)
+    try:
+        user_id = use_refresh_token(token)
+        if user_id is None:
+            # Save any revocations of a reused token
+            db.session.commit()
+            msg = {'message': "Invalid refresh token. Please log in again."}
+            return make_response(msg, 401)
+        new_refresh_token = issue_refresh_token(user_id)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"An error occurred refreshing the token: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return make_response(jsonify({
+        "user_id": user_id, "token": encode_auth_token(user_id),
+        "refresh_token": new_refresh_token}), 201)
+
+
+@app.post('/token/revoke')
+def revoke_token():
+    """Revokes a refresh token, e.g. when the user logs out
 
-    # Return the token and the user_id of the logged in user
-    return make_response(jsonify({"user_id": user.user_id, "token": token}), 201)
+    If the refresh token is missing, return 400 error
+    Otherwise return 200 Success, whether or not the token was found
+    """
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if not isinstance(token, str) or not token:
+        msg = {'message': 'Missing refresh token'}
+        return make_response(msg, 400)
+    try:
+        revoke_refresh_token(token)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.error(f"An error occurred revoking the token: {str(e)}")
+        msg = {'message': "An Internal Server Error occurred."}
+        return make_response(msg, 500)
+    return {'message': "Refresh token revoked."}
@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+from sqlalchemy import inspect
+
 from src.models import User, Feedback, Age_group, Gender, Ethnicity, \
     Employment, Course_level, Teacher, Disability
 from src import db, ma
@@ -103,3 +107,56 @@ class TeacherSchema(ma.SQLAlchemyAutoSchema):
         load_instance = True
         sqla_session = db.session
         include_relationships = True
+
+
+@lru_cache(maxsize=256)
+def _projection_schema(schema_class, fields, many):
+    return schema_class(only=fields, many=many)
+
+
+def projection_schema(schema, fields):
+    """Returns a schema like the given one that only dumps some fields.
+
+    The schemas are cached, so each projection is only built once.
+
+    Args:
+        schema: A schema instance, e.g. Teachers_schema
+        fields: tuple of the field names to dump
+    """
+    return _projection_schema(type(schema), fields, schema.many)
+
+
+def item_schema(schema, fields=None):
+    """Returns a cached schema like the given one that dumps single rows.
+
+    Args:
+        schema: A schema instance, e.g. Teachers_schema
+        fields: Optional tuple of the field names to dump
+    """
+    return _projection_schema(type(schema), fields, False)
+
+
+@lru_cache(maxsize=None)
+def row_schema(schema_class, many=False):
+    """Returns a schema like the given one that loads column values.
+
+    The items are loaded as dicts of column values, not model instances, so
+    loading does not query the database and the dicts can be passed straight
+    to an INSERT or UPDATE statement. Relationship fields are left out, the
+    foreign key columns are loaded instead.
+
+    Args:
+        schema_class: A schema class, e.g. TeacherSchema
+        many: Whether the schema validates a list of items
+    """
+    relationships = inspect(schema_class.Meta.model).relationships.keys()
+    return schema_class(many=many, load_instance=False,
+                        exclude=relationships)
+
+
+def bulk_schema(schema_class):
+    """Returns a schema like the given one that validates many items.
+
+    See row_schema().
+    """
+    return row_schema(schema_class, many=True)
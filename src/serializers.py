@@ -0,0 +1,119 @@
+# Fast JSON encoding of rows for the read routes, without Marshmallow
+import json
+from functools import lru_cache
+
+from flask import current_app as app
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+
+def dumps(data, sort_keys=False):
+    """Encodes data as compact JSON bytes, with orjson if it is enabled."""
+    if orjson is not None and app.config["FAST_SERIALIZATION_ORJSON"]:
+        return orjson.dumps(
+            data, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    return json.dumps(data, separators=(",", ":"),
+                      sort_keys=sort_keys).encode()
+
+
+class RowEncoder:
+    """Encodes Core row tuples of one table to JSON.
+
+    The output is the same as dumping the ORM objects with the table's
+    Marshmallow schema and returning them with Flask, for schemas whose
+    fields are all plain columns.
+
+    Attributes:
+        keys: The names of the fields in the output, in the order Flask
+            sorts them
+        columns: The table columns to select, in the same order as keys
+    """
+
+    def __init__(self, keys, columns):
+        self.keys = keys
+        self.columns = columns
+
+    def dicts(self, rows):
+        """Returns the rows as a list of dicts.
+
+        Rows may have extra columns after the keys, these are ignored.
+        """
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in rows]
+
+    def row_dict(self, row):
+        """Returns one row as a dict."""
+        return dict(zip(self.keys, row))
+
+    def encode(self, data):
+        """Encodes a dict or list of dicts as JSON bytes.
+
+        Like Flask, the JSON is compact and ends with a newline.
+        """
+        return dumps(data) + b"\n"
+
+
+@lru_cache(maxsize=256)
+def get_encoder(model, schema_class, fields=None):
+    """Returns the encoder for a table and schema.
+
+    Args:
+        model: The model class of the table
+        schema_class: The Marshmallow schema class for the table
+        fields: Optional tuple of the fields to output, defaults to all the
+            fields of the schema
+
+    Returns:
+        A RowEncoder, or None if any field is not a plain column (e.g. a
+        relationship), in which case the schema must be used
+    """
+    columns = model.__table__.c
+    keys = fields or tuple(schema_class().fields)
+    if any(key not in columns for key in keys):
+        return None
+    # Flask sorts the keys of JSON objects, so select them in that order
+    keys = tuple(sorted(keys))
+    return RowEncoder(keys, tuple(columns[key] for key in keys))
+
+
+def fast_encoder(model, schema, fields=None):
+    """Returns the encoder to use for a read, if fast serialization is on.
+
+    Args:
+        model: The model class of the table
+        schema: The Marshmallow schema instance the route would dump with
+        fields: Optional tuple of the fields requested
+
+    Returns:
+        A RowEncoder, or None if the schema should be used
+    """
+    if not app.config["FAST_SERIALIZATION"]:
+        return None
+    return get_encoder(model, type(schema), fields)
+
+
+def stream_rows(partitions, encode_row, ndjson):
+    """Generates the body of a streamed JSON response.
+
+    Args:
+        partitions: An iterable of lists of rows, e.g. from
+            Result.partitions() with the yield_per execution option
+        encode_row: Function that encodes one row as JSON bytes
+        ndjson: If True each row is written on its own line, otherwise the
+            rows are written as one JSON array
+
+    Yields:
+        The encoded rows, one partition at a time
+    """
+    if ndjson:
+        for rows in partitions:
+            yield b"".join([encode_row(row) + b"\n" for row in rows])
+        return
+    separator = b"["
+    for rows in partitions:
+        yield separator + b",".join([encode_row(row) for row in rows])
+        separator = b","
+    yield b"[]\n" if separator == b"[" else b"]\n"
@@ -0,0 +1,324 @@
+# Read-only columnar copies of the data tables held in each worker process
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from flask import current_app as app
+from sqlalchemy import inspect
+
+from src import db
+from src.records import RECORD_MODELS, record_columns
+from src.versions import table_versions
+
+# The tables copied into the snapshot, their rows are never changed through
+# the snapshot
+SNAPSHOT_MODELS = RECORD_MODELS
+
+# A snapshot of every table, with the table versions it was read at
+Snapshot = namedtuple("Snapshot", "versions tables")
+
+
+class TableSnapshot:
+    """An immutable copy of one table as a NumPy array per column.
+
+    The rows are in primary key order.
+
+    Attributes:
+        pk: The name of the primary key column
+        columns: dict mapping each column name to an array of its values
+    """
+
+    def __init__(self, pk, columns):
+        self.pk = pk
+        self.columns = columns
+        for array in columns.values():
+            array.flags.writeable = False
+
+    @classmethod
+    def load(cls, session, model):
+        """Reads a table into a snapshot."""
+        pk = inspect(model).primary_key[0]
+        table = model.__table__
+        rows = session.execute(
+            table.select().order_by(pk)).all()
+        values = list(zip(*rows)) or [()] * len(table.c)
+        columns = {}
+        for column, column_values in zip(table.c, values):
+            try:
+                array = np.array(column_values,
+                                 dtype=np.int64 if column.type.python_type
+                                 is int else object)
+            except (TypeError, ValueError):
+                # e.g. a text value stored in an integer column
+                array = np.array(column_values, dtype=object)
+            columns[column.name] = array
+        return cls(pk.name, columns)
+
+    def __len__(self):
+        return len(self.columns[self.pk])
+
+    def dicts(self, keys, rows=slice(None)):
+        """Returns the rows as a list of dicts of the given columns.
+
+        Args:
+            keys: The names of the columns
+            rows: Slice, boolean mask or positions of the rows to return
+        """
+        values = [self.columns[key][rows].tolist() for key in keys]
+        return [dict(zip(keys, row)) for row in zip(*values)]
+
+    def page(self, keys, after=None, limit=None):
+        """Returns a page of rows, as list_resource() does from the database.
+
+        Args:
+            keys: The names of the columns to return
+            after: Optional primary key to start after
+            limit: Optional maximum number of rows
+
+        Returns:
+            (rows, last) where rows is a list of dicts and last is the
+            primary key of the last row if there is another page, else None
+        """
+        ids = self.columns[self.pk]
+        start = 0 if after is None \
+            else int(np.searchsorted(ids, after, side="right"))
+        stop = len(ids) if limit is None else min(start + limit, len(ids))
+        last = int(ids[stop - 1]) if stop < len(ids) and limit else None
+        return self.dicts(keys, slice(start, stop)), last
+
+    def find(self, keys, ids):
+        """Returns the rows with the primary keys.
+
+        Args:
+            keys: The names of the columns to return
+            ids: list of int primary keys
+
+        Returns:
+            dict mapping each id that was found to its row as a dict
+        """
+        table_ids = self.columns[self.pk]
+        ids = np.unique(np.array(ids, dtype=np.int64))
+        positions = np.searchsorted(table_ids, ids)
+        found = positions < len(table_ids)
+        found[found] = table_ids[positions[found]] == ids[found]
+        return dict(zip(ids[found].tolist(),
+                        self.dicts(keys, positions[found])))
+
+    def get(self, keys, id):
+        """Returns the row with the primary key as a dict, or None."""
+        ids = self.columns[self.pk]
+        try:
+            id = int(id)
+        except ValueError:
+            return None
+        position = int(np.searchsorted(ids, id))
+        if position == len(ids) or ids[position] != id:
+            return None
+        return self.dicts(keys, slice(position, position + 1))[0]
+
+
+class SnapshotStore:
+    """Holds the current snapshot of the tables for a worker process.
+
+    A new snapshot is read, and swapped in for the current one, when a
+    write to one of the tables is committed in this process. Writes made
+    by other processes are found by checking the table versions at most
+    once every max_age seconds, so reads in between do not use the
+    database. Only the tables that changed are read again.
+
+    Attributes:
+        max_age: Seconds between checks for writes by other processes
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._tables = [model.__tablename__ for model in SNAPSHOT_MODELS]
+        self._models = {model.__tablename__: model
+                        for model in SNAPSHOT_MODELS}
+        self._current = None
+        self._records = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        """Returns the current snapshot, reading changed tables if needed.
+
+        Args:
+            session: The SQLAlchemy session used if tables must be read
+        """
+        checked = self._checked
+        if checked is not None and time.monotonic() - checked < self.max_age:
+            return self._current
+        with self._lock:
+            checked = self._checked
+            if checked is not None \
+                    and time.monotonic() - checked < self.max_age:
+                return self._current
+            self._checked = time.monotonic()
+            versions = table_versions(session, self._tables)
+            current = self._current
+            if current is None or current.versions != versions:
+                tables = dict(current.tables) if current else {}
+                for name in self._tables:
+                    if current is None \
+                            or current.versions[name] != versions[name]:
+                        tables[name] = TableSnapshot.load(
+                            session, self._models[name])
+                self._current = Snapshot(versions, tables)
+                self._records = None
+            return self._current
+
+    def versions(self, session, tables):
+        """Returns the versions of the tables in the current snapshot.
+
+        Returns:
+            dict of the version of each table, or None if any of the tables
+            is not in the snapshot
+        """
+        if not set(tables) <= set(self._tables):
+            return None
+        versions = self.get(session).versions
+        return {table: versions[table] for table in tables}
+
+    def records(self, session):
+        """Returns the joined records of the current snapshot.
+
+        See snapshot_records(), the records are only joined once for each
+        snapshot.
+        """
+        snapshot = self.get(session)
+        records = self._records
+        if records is None or records[0] is not snapshot:
+            records = (snapshot, snapshot_records(snapshot))
+            self._records = records
+        return records[1]
+
+    def invalidate(self, tables):
+        """Makes the next get() check for changes, after a commit."""
+        if set(tables) & set(self._tables):
+            self._checked = None
+
+
+def snapshot_records(snapshot):
+    """Joins the record tables of a snapshot on their ids.
+
+    Returns:
+        dict mapping each field of a record (see record_columns()) to an
+        array of its values, in record_id order
+    """
+    tables = snapshot.tables
+    ids = None
+    for model in RECORD_MODELS:
+        table = tables[model.__tablename__]
+        table_ids = table.columns[table.pk]
+        ids = table_ids if ids is None \
+            else np.intersect1d(ids, table_ids, assume_unique=True)
+    records = {}
+    positions = {}
+    for name, column in record_columns().items():
+        table = tables[column.table.name]
+        if column.table.name not in positions:
+            positions[column.table.name] = np.searchsorted(
+                table.columns[table.pk], ids)
+        array = table.columns[column.name][positions[column.table.name]]
+        array.flags.writeable = False
+        records[name] = array
+    return records
+
+
+def find_records(records, filters, after=None, limit=None):
+    """Finds the records that match filters, as /Records does in SQL.
+
+    Args:
+        records: dict of record field arrays, see snapshot_records()
+        filters: dict mapping field names to lists of values to match
+        after: Optional record_id to start after
+        limit: Optional maximum number of records
+
+    Returns:
+        (positions, last) where positions is an array of the positions of
+        the matching records and last is the record_id of the last one if
+        there are more, else None
+    """
+    mask = np.ones(len(records['record_id']), dtype=bool)
+    for name, values in filters.items():
+        mask &= np.isin(records[name], values)
+    if after is not None:
+        mask &= records['record_id'] > after
+    positions = np.flatnonzero(mask)
+    last = None
+    if limit is not None and len(positions) > limit:
+        positions = positions[:limit]
+        last = int(records['record_id'][positions[-1]])
+    return positions, last
+
+
+def record_dicts(records, keys, positions):
+    """Returns the records at the positions as dicts of the given fields."""
+    values = [records[key][positions].tolist() for key in keys]
+    return [dict(zip(keys, row)) for row in zip(*values)]
+
+
+def aggregate_records(records, group_by, positions):
+    """Aggregates records by group, as /aggregate does in SQL.
+
+    Args:
+        records: dict of record field arrays, see snapshot_records()
+        group_by: Tuple of the fields to group by
+        positions: Array of the positions of the records to aggregate
+
+    Returns:
+        list of dicts with the group_by fields, 'n_total', 'count' and the
+        weighted mean of each pct_ field, ordered by the group_by fields
+    """
+    n_total = records['n_total'][positions]
+    # Number the groups by combining the codes of their values, so that the
+    # groups sort in the same order as the values
+    codes = np.zeros(len(positions), dtype=np.int64)
+    for name in group_by:
+        values, index = np.unique(records[name][positions],
+                                  return_inverse=True)
+        codes = codes * len(values) + index
+    groups, first, index = np.unique(codes, return_index=True,
+                                     return_inverse=True)
+    if not group_by and not len(groups):
+        # SQL returns one row for the aggregates of no records
+        groups, first, index = np.zeros(1), np.zeros(0, dtype=int), index
+    count = np.bincount(index, minlength=len(groups))
+    totals = np.bincount(index, weights=n_total, minlength=len(groups))
+    aggregates = {name: records[name][positions][first].tolist()
+                  for name in group_by}
+    aggregates['count'] = count.tolist()
+    aggregates['n_total'] = [int(total) if found else None
+                             for total, found in zip(totals.tolist(), count)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name in records:
+            if name.startswith('pct_'):
+                weighted = np.bincount(
+                    index, weights=records[name][positions] * n_total,
+                    minlength=len(groups))
+                means = weighted / totals
+                aggregates[name] = [mean if total else None for mean, total
+                                    in zip(means.tolist(), totals.tolist())]
+    keys = sorted(aggregates)
+    return [dict(zip(keys, row))
+            for row in zip(*(aggregates[key] for key in keys))]
+
+
+def current_store():
+    """Returns the app's snapshot store, or None if reads use the database."""
+    return app.extensions.get("snapshot")
+
+
+def snapshot_table(model):
+    """Returns the current snapshot of a table.
+
+    Returns:
+        A TableSnapshot, or None if the table should be read from the
+        database
+    """
+    store = current_store()
+    if store is None or model not in SNAPSHOT_MODELS:
+        return None
+    return store.get(db.session).tables[model.__tablename__]
@@ -0,0 +1,128 @@
+# Year over year trends of each series, computed with NumPy
+import numpy as np
+from flask import current_app as app
+
+from src.records import RECORD_MODELS, record_columns, select_records
+from src.versions import table_versions
+
+# The dimensions that identify a series
+SERIES = ('course_level_recoded', 'qts_status', 'employment_status')
+
+def metrics():
+    """Returns the names of the record fields that trends can be found for."""
+    return ['n_total'] + [name for name in record_columns()
+                          if name.startswith('pct_')]
+
+
+def load_records(session):
+    """Returns the records as one NumPy array per field.
+
+    The arrays are read once and kept on the app until one of the record
+    tables is written to, so repeated calls only look up the table
+    versions. The arrays must not be changed.
+
+    Args:
+        session: The SQLAlchemy session to read with
+
+    Returns:
+        dict mapping each field name to an array of its values
+    """
+    versions = table_versions(
+        session, [model.__tablename__ for model in RECORD_MODELS])
+    key = (str(session.get_bind().url), tuple(sorted(versions.items())))
+    # The columnar copy of the records, and the database and table versions
+    # it was read at
+    cached_key, arrays = app.extensions.get('trend_records', (None, None))
+    if cached_key != key:
+        names = [*SERIES, 'time_period', *metrics()]
+        columns = record_columns()
+        rows = session.execute(
+            select_records(*(columns[name] for name in names))).all()
+        values = list(zip(*rows)) or [()] * len(names)
+        arrays = {name: np.array(column, dtype=object if name in SERIES
+                                 else float)
+                  for name, column in zip(names, values)}
+        app.extensions['trend_records'] = (key, arrays)
+    return arrays
+
+
+def start_year(time_period):
+    """Returns the first calendar year of academic years such as 201819."""
+    return time_period // 100
+
+
+def compute_trends(records, metric):
+    """Computes the trend of a metric for every series in one pass.
+
+    Records of the same series and time period are combined: n_total is
+    summed and percentages are averaged weighted by n_total.
+
+    Args:
+        records: dict of field arrays, see load_records()
+        metric: 'n_total' or the name of a percentage field
+
+    Returns:
+        list with a dict for each series with its SERIES values and lists
+        of 'time_period', 'value', 'change' (from the previous time period)
+        and 'pct_change', and its compound annual growth rate 'cagr'
+        between the first and last time periods it has a value for. Values
+        that cannot be computed are None.
+    """
+    if not len(records['time_period']):
+        return []
+    # Number each series by combining the codes of its dimension values
+    codes = np.zeros(len(records['time_period']), dtype=np.int64)
+    for name in SERIES:
+        values, index = np.unique(records[name].astype(str),
+                                  return_inverse=True)
+        codes = codes * len(values) + index
+    series, first_record, series_index = np.unique(
+        codes, return_index=True, return_inverse=True)
+    periods, period_index = np.unique(records['time_period'],
+                                      return_inverse=True)
+    shape = (len(series), len(periods))
+    n_total = np.zeros(shape)
+    np.add.at(n_total, (series_index, period_index), records['n_total'])
+    found = np.zeros(shape, dtype=bool)
+    found[series_index, period_index] = True
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'n_total':
+            values = n_total
+        else:
+            weighted = np.zeros(shape)
+            np.add.at(weighted, (series_index, period_index),
+                      records[metric] * records['n_total'])
+            values = weighted / n_total
+        values = np.where(found, values, np.nan)
+        change = np.full(shape, np.nan)
+        change[:, 1:] = values[:, 1:] - values[:, :-1]
+        pct_change = np.full(shape, np.nan)
+        pct_change[:, 1:] = change[:, 1:] / values[:, :-1] * 100
+
+        # The first and last time period of each series with a value
+        has_value = ~np.isnan(values)
+        first = has_value.argmax(axis=1)
+        last = shape[1] - 1 - has_value[:, ::-1].argmax(axis=1)
+        rows = np.arange(shape[0])
+        years = start_year(periods.astype(int))
+        span = years[last] - years[first]
+        cagr = (values[rows, last] / values[rows, first]) ** (1 / span) - 1
+        cagr[(span <= 0) | ~np.isfinite(cagr)] = np.nan
+
+    trends = []
+    time_periods = periods.astype(int).tolist()
+    for i, record in enumerate(first_record.tolist()):
+        trend = {name: records[name][record] for name in SERIES}
+        trend['time_period'] = time_periods
+        trend['value'] = _to_list(values[i], integer=metric == 'n_total')
+        trend['change'] = _to_list(change[i])
+        trend['pct_change'] = _to_list(pct_change[i])
+        trend['cagr'] = _to_list(cagr[i:i + 1])[0]
+        trends.append(trend)
+    return trends
+
+
+def _to_list(values, integer=False):
+    """Returns a float array as a list, with None for NaN and infinity."""
+    convert = int if integer else float
+    return [convert(v) if np.isfinite(v) else None for v in values.tolist()]
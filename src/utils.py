@@ -1,136 +1,492 @@
 # Helper classes and functions for the application
 import csv
+import gzip
+import hashlib
+import itertools
+import multiprocessing
 from pathlib import Path
 
+from flask import current_app
+from sqlalchemy import inspect
 
-# Add data to the database if it does not already exist
-def add_data(db):
-    """Adds data to the database if it does not already exist."""
+# The prepared dataset that is loaded into the database
+DATA_FILE = Path(__file__).parent.parent.joinpath("data", "df_prepared.csv")
+
+# Increase when a change to the data tables means the data must be reloaded
+SCHEMA_VERSION = 1
+
+# The CSV columns that identify one observation
+NATURAL_KEY = ('time_period', 'course_level_recoded', 'qts_status',
+               'employment_status')
+
+
+def table_columns():
+    """Returns the CSV columns that are stored in each of the data tables.
 
+    Each row of the CSV is split column-wise across the tables; the row at
+    position n is stored with id n in every table.
+
+    Returns:
+        dict mapping each model class to a tuple of its CSV column names
+    """
     # Add import here and not at the top of the file to avoid circular import
     # issues
     from src.models import Age_group, Gender, Ethnicity, Employment, \
         Course_level, Teacher, Disability
 
-    # If there are no age groups in the database, then add them
-    first_age = db.session.execute(db.select(Age_group)).first()
-    if not first_age:
-        print("Start adding age group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                a = Age_group(time_period=row['time_period'],
-                              pct_total_age_u25=row['pct_total_age_u25'],
-                              pct_total_age_25andover=row[
-                                  'pct_total_age_25andover'])
-                db.session.add(a)
-            db.session.commit()
+    return {
+        Age_group: ('time_period', 'pct_total_age_u25',
+                    'pct_total_age_25andover'),
+        Gender: ('time_period', 'pct_total_sex_m', 'pct_total_sex_f'),
+        Ethnicity: ('time_period', 'pct_total_ethnic_asian',
+                    'pct_total_ethnic_black', 'pct_total_ethnic_white',
+                    'pct_total_ethnic_mixed_ethnicity',
+                    'pct_total_ethnic_other', 'pct_total_ethnic_unknown'),
+        Employment: ('time_period', 'employment_status'),
+        Course_level: ('time_period', 'course_level_recoded'),
+        Disability: ('time_period', 'pct_total_disability',
+                     'pct_total_nondisability',
+                     'pct_total_disability_unknown'),
+        Teacher: ('time_period', 'qts_status', 'n_total'),
+    }
 
-    # If there are no gender groups in the database, then add them
-    first_gender = db.session.execute(db.select(Gender)).first()
-    if not first_gender:
-        print("Start adding gender group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                g = Gender(time_period=row['time_period'],
-                           pct_total_sex_m=row['pct_total_sex_m'],
-                           pct_total_sex_f=row['pct_total_sex_f'])
-                db.session.add(g)
-            db.session.commit()
 
-    # If there are no ethnicity groups in the database, then add them
-    first_ethnicity = db.session.execute(db.select(Ethnicity)).first()
-    if not first_ethnicity:
-        print("Start adding ethnicity group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                e = Ethnicity(time_period=row['time_period'],
-                              pct_total_ethnic_asian=row[
-                                  'pct_total_ethnic_asian'],
-                              pct_total_ethnic_black=row[
-                                  'pct_total_ethnic_black'],
-                              pct_total_ethnic_white=row[
-                                  'pct_total_ethnic_white'],
-                              pct_total_ethnic_mixed_ethnicity=row[
-                                  'pct_total_ethnic_mixed_ethnicity'],
-                              pct_total_ethnic_other=row[
-                                  'pct_total_ethnic_other'],
-                              pct_total_ethnic_unknown=row[
-                                  'pct_total_ethnic_unknown'])
-                db.session.add(e)
-            db.session.commit()
+def primary_key(model):
+    """Returns the name of the primary key column of a model."""
+    return inspect(model).primary_key[0].name
 
 
-# If there are no employment groups in the database, then add them
-    first_employment = db.session.execute(db.select(Employment)).first()
-    if not first_employment:
-        print("Start adding employment group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                em = Employment(time_period=row['time_period'],
-                                employment_status=row['employment_status'])
-                db.session.add(em)
-            db.session.commit()
+def csv_columns():
+    """Returns the names of all the CSV columns stored in the data tables."""
+    return tuple(dict.fromkeys(itertools.chain(*table_columns().values())))
 
 
-# If there are no course_level groups in the database, then add them
-    first_course_level = db.session.execute(db.select(Course_level)).first()
-    if not first_course_level:
-        print("Start adding course_level group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                c = Course_level(time_period=row['time_period'],
-                                 course_level_recoded=row[
-                                     'course_level_recoded'])
-                db.session.add(c)
-            db.session.commit()
+def split_rows(rows, models=None, first_id=None):
+    """Splits CSV rows into the rows for each data table.
 
+    Args:
+        rows: An iterable of dicts, one per CSV row
+        models: The models to build rows for, defaults to all the data tables
+        first_id: If given, the rows are numbered from this id so that each
+            CSV row has the same id in every table
 
-# If there are no disability groups in the database, then add them
-    first_disability = db.session.execute(db.select(Disability)).first()
-    if not first_disability:
-        print("Start adding disability group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                d = Disability(time_period=row['time_period'],
-                               pct_total_disability=row[
-                                   'pct_total_disability'],
-                               pct_total_nondisability=row[
-                                   'pct_total_nondisability'],
-                               pct_total_disability_unknown=row[
-                                   'pct_total_disability_unknown'])
-                db.session.add(d)
-            db.session.commit()
+    Returns:
+        dict mapping each model class to a list of row dicts ready for a bulk
+        insert
+    """
+    columns = table_columns()
+    if models is not None:
+        columns = {model: columns[model] for model in models}
+    table_rows = {model: [] for model in columns}
+    for n, row in enumerate(rows):
+        for model, names in columns.items():
+            table_row = {name: row[name] for name in names}
+            if first_id is not None:
+                table_row[primary_key(model)] = first_id + n
+            table_rows[model].append(table_row)
+    return table_rows
+
+
+def bulk_insert(db, table_rows):
+    """Inserts the rows for each table using one executemany per table.
+
+    The caller is responsible for committing the transaction.
+
+    Args:
+        db: The SQLAlchemy database
+        table_rows: dict mapping model classes to lists of row dicts
+    """
+    for model, rows in table_rows.items():
+        if rows:
+            db.session.execute(db.insert(model), rows)
+
+
+def file_fingerprint(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Add data to the database if it does not already exist
+def add_data(db, path=DATA_FILE):
+    """Adds data to the database if it does not already exist.
 
+    The fingerprint of the CSV and the schema version recorded by the last
+    load are checked first; if both match there is nothing to do. If the
+    CSV has changed since it was loaded the data tables are reseeded when
+    RESEED_ON_DATA_CHANGE is set, otherwise a RuntimeError is raised.
 
-# If there are no teacher groups in the database, then add them
-    first_teacher = db.session.execute(db.select(Teacher)).first()
-    if not first_teacher:
-        print("Start adding teacher group data to the database")
-        df_prepared = Path(__file__).parent.parent.joinpath("data",
-                                                            "df_prepared.csv")
-        with open(df_prepared, 'r') as file:
-            csv_dict_reader = csv.DictReader(file)
-            for row in csv_dict_reader:
-                t = Teacher(time_period=row['time_period'],
-                            qts_status=row['qts_status'],
-                            n_total=row['n_total'])
-                db.session.add(t)
+    The CSV is read once and the rows for every empty table are written in
+    a single transaction.
+    """
+    # Add import here and not at the top of the file to avoid circular import
+    # issues
+    from src.models import Data_source, Cube_cell
+    from src.cube import update_cube
+
+    fingerprint = file_fingerprint(path)
+    source = db.session.get(Data_source, 1)
+    if source and source.file_hash == fingerprint \
+            and source.schema_version == SCHEMA_VERSION:
+        # Build the cube for a database created before there was one
+        if not db.session.execute(db.select(Cube_cell).limit(1)).first():
+            update_cube(db.session)
             db.session.commit()
+        return
+
+    if source:
+        if not current_app.config.get('RESEED_ON_DATA_CHANGE'):
+            raise RuntimeError(
+                f"{Path(path).name} has changed since it was loaded into the "
+                f"database. Set RESEED_ON_DATA_CHANGE to reload it.")
+        print("Data file has changed, reloading the data")
+        reload_data(db, path)
+        return
+
+    # Find the tables that do not have any data yet
+    empty = [model for model in table_columns()
+             if not db.session.execute(db.select(model).limit(1)).first()]
+    if empty:
+        print(f"Start adding {', '.join(m.__tablename__ for m in empty)} "
+              f"data to the database")
+        with open(path, 'r') as file:
+            table_rows = split_rows(csv.DictReader(file), models=empty)
+        bulk_insert(db, table_rows)
+
+    # Record what was loaded so the next startup can skip the checks
+    db.session.merge(Data_source(data_source_id=1, file_hash=fingerprint,
+                                 schema_version=SCHEMA_VERSION))
+    db.session.commit()
+
+
+def reload_data(db, path=DATA_FILE):
+    """Applies the differences between a CSV and the data tables.
+
+    Rows are matched on NATURAL_KEY. CSV rows that are not in the database
+    are inserted into every table under a new id, rows whose values differ
+    are updated in the tables that changed, and observations that are no
+    longer in the CSV are deleted from every table. All the changes are
+    made in one transaction.
+
+    Args:
+        db: The SQLAlchemy database
+        path: The CSV file to load
+
+    Returns:
+        dict with the number of observations inserted, updated and deleted
+
+    Raises:
+        ValueError: If the CSV or the database contains the same natural key
+            more than once
+    """
+    from src.models import Data_source, Teacher, Course_level, Employment
+
+    columns = table_columns()
+    with open(path, 'r') as file:
+        rows = list(csv.DictReader(file))
+
+    # Map the natural key of each complete observation to its id
+    key_ids = {}
+    for r in db.session.execute(
+            db.select(Teacher.teacher_id, Teacher.time_period,
+                      Course_level.course_level_recoded, Teacher.qts_status,
+                      Employment.employment_status)
+            .join(Course_level,
+                  Course_level.course_level_id == Teacher.teacher_id)
+            .join(Employment, Employment.employment_id == Teacher.teacher_id)
+            .order_by(Teacher.teacher_id)):
+        key = (str(r.time_period), r.course_level_recoded, r.qts_status,
+               r.employment_status)
+        if key in key_ids:
+            raise ValueError(
+                f"Duplicate rows in the database for {key}: ids "
+                f"{key_ids[key]} and {r.teacher_id}, remove one before "
+                f"reloading")
+        key_ids[key] = r.teacher_id
+    # The stored values of every table, keyed by id
+    stored = {}
+    for model, names in columns.items():
+        pk = inspect(model).primary_key[0]
+        stored[model] = {
+            r[0]: tuple(str(value) for value in r[1:])
+            for r in db.session.execute(
+                db.select(pk, *(getattr(model, name) for name in names)))
+        }
+    next_id = max([max(ids, default=0) for ids in stored.values()]) + 1
+
+    inserts = {model: [] for model in columns}
+    updates = {model: [] for model in columns}
+    seen = set()
+    inserted = updated = 0
+    for row in rows:
+        key = tuple(row[name] for name in NATURAL_KEY)
+        if key in seen:
+            raise ValueError(f"Duplicate row in {Path(path).name}: {key}")
+        seen.add(key)
+        row_id = key_ids.get(key)
+        is_new = row_id is None
+        if is_new:
+            row_id = next_id
+            next_id += 1
+            inserted += 1
+        changed = False
+        for model, names in columns.items():
+            values = tuple(row[name] for name in names)
+            existing = stored[model].get(row_id)
+            if existing == values:
+                continue
+            table_row = dict(zip(names, values))
+            table_row[primary_key(model)] = row_id
+            if existing is None:
+                inserts[model].append(table_row)
+            else:
+                updates[model].append(table_row)
+                changed = True
+        if changed and not is_new:
+            updated += 1
+
+    # Observations that are no longer in the file
+    removed = [row_id for key, row_id in key_ids.items() if key not in seen]
+    for model in columns:
+        if removed:
+            pk = inspect(model).primary_key[0]
+            db.session.execute(db.delete(model).where(pk.in_(removed)))
+        if updates[model]:
+            db.session.execute(db.update(model), updates[model])
+    bulk_insert(db, inserts)
+
+    db.session.merge(Data_source(data_source_id=1,
+                                 file_hash=file_fingerprint(path),
+                                 schema_version=SCHEMA_VERSION))
+    db.session.commit()
+    return {'inserted': inserted, 'updated': updated,
+            'deleted': len(removed)}
+
+
+def open_csv(path):
+    """Opens a plain or gzip compressed (.gz) CSV file for reading."""
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rt', newline='')
+    return open(path, 'r', newline='')
+
+
+def read_chunks(path, chunk_size, columns):
+    """Reads a CSV file in chunks of columns.
+
+    Only one chunk of the file is held in memory at a time.
+
+    Args:
+        path: A plain or gzip compressed CSV file
+        chunk_size: The maximum number of rows in each chunk
+        columns: The columns to keep from the file
+
+    Yields:
+        dicts mapping each column name to a sequence of up to chunk_size
+        values
+
+    Raises:
+        ValueError: If the file is missing any of the columns
+    """
+    with open_csv(path) as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        missing = set(columns).difference(header)
+        if missing:
+            raise ValueError(f"{path} is missing the columns "
+                             f"{', '.join(sorted(missing))}")
+        positions = [header.index(name) for name in columns]
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+            values = list(zip(*rows))
+            yield {name: values[position]
+                   for name, position in zip(columns, positions)}
+
+
+def read_arrow_chunks(path, chunk_size, columns):
+    """Reads a Parquet or Arrow IPC file in chunks of columns.
+
+    The values are taken straight from the Arrow record batches, one column
+    at a time.
+
+    Args:
+        path: A .parquet file, or an Arrow IPC (.arrow, .feather, .ipc) file
+        chunk_size: The maximum number of rows in each chunk
+        columns: The columns to keep from the file
+
+    Yields:
+        dicts mapping each column name to a list of up to chunk_size values
+
+    Raises:
+        ValueError: If the file is missing any of the columns
+    """
+    # pyarrow is slow to import, so only import it when it is used
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    if str(path).endswith('.parquet'):
+        file = pyarrow.parquet.ParquetFile(path)
+        names = file.schema_arrow.names
+        batches = file.iter_batches(batch_size=chunk_size, columns=[
+            name for name in columns if name in names])
+    else:
+        reader = pyarrow.ipc.open_file(path)
+        names = reader.schema.names
+        batches = (reader.get_batch(i)
+                   for i in range(reader.num_record_batches))
+    missing = set(columns).difference(names)
+    if missing:
+        raise ValueError(f"{path} is missing the columns "
+                         f"{', '.join(sorted(missing))}")
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunk_size):
+            part = batch.slice(start, chunk_size)
+            yield {name: part.column(name).to_pylist() for name in columns}
+
+
+# File extensions that are read with pyarrow rather than as CSV
+ARROW_SUFFIXES = ('.parquet', '.arrow', '.feather', '.ipc')
+
+
+def read_file_chunks(path, chunk_size, columns):
+    """Reads a CSV, gzip CSV, Parquet or Arrow IPC file in chunks."""
+    if str(path).endswith(ARROW_SUFFIXES):
+        return read_arrow_chunks(path, chunk_size, columns)
+    return read_chunks(path, chunk_size, columns)
+
+
+def insert_columns(db, chunk, first_id):
+    """Inserts a chunk of columns into every data table.
+
+    The rows are numbered from first_id so that each row has the same id in
+    every table. The values are passed to the database driver's executemany
+    as tuples, without building a dict per row. The caller is responsible
+    for committing the transaction.
+
+    Args:
+        db: The SQLAlchemy database
+        chunk: dict mapping each CSV column name to a sequence of values
+        first_id: The id of the first row in the chunk
+    """
+    from src.versions import bump_versions
+    from src.cube import cell_keys, update_cube
+
+    connection = db.session.connection()
+    ids = range(first_id, first_id + len(next(iter(chunk.values()))))
+    for model, names in table_columns().items():
+        table = model.__table__
+        keys = (primary_key(model),) + names
+        compiled = db.insert(table).values(
+            {key: db.bindparam(key) for key in keys}).compile(
+            dialect=connection.dialect)
+        columns = [ids] + [chunk[name] for name in names]
+        if compiled.positional:
+            order = [keys.index(key) for key in compiled.positiontup]
+            params = list(zip(*(columns[position] for position in order)))
+        else:
+            params = [dict(zip(keys, values)) for values in zip(*columns)]
+        connection.exec_driver_sql(str(compiled), params)
+    bump_versions(db.session, [model.__tablename__
+                               for model in table_columns()])
+    update_cube(db.session, cell_keys(db.session, ids))
+
+
+# The queue that a reader process sends its chunks back on
+_chunk_queue = None
+
+
+def _init_reader(queue):
+    """Initialises a reader process with the queue to send chunks on."""
+    global _chunk_queue
+    _chunk_queue = queue
+
+
+def _read_file(path, chunk_size, columns):
+    """Reads a file in a reader process and sends its chunks to the queue.
+
+    The file is followed by None on success or by the exception on failure.
+    """
+    try:
+        for chunk in read_file_chunks(path, chunk_size, columns):
+            _chunk_queue.put((path, chunk))
+    except Exception as e:
+        _chunk_queue.put((path, e))
+        return
+    _chunk_queue.put((path, None))
+
+
+def iter_file_chunks(paths, chunk_size, workers=1):
+    """Reads several data files in chunks, optionally in parallel.
+
+    With more than one worker the files are read and parsed in separate
+    processes. The chunks are passed back through a bounded queue so at most
+    a few chunks per worker are held in memory at once.
+
+    Args:
+        paths: The CSV, gzip CSV, Parquet or Arrow IPC files to read
+        chunk_size: The maximum number of rows in each chunk
+        workers: The number of reader processes to use
+
+    Yields:
+        (path, chunk) tuples where chunk maps column names to values
+    """
+    columns = csv_columns()
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            for chunk in read_file_chunks(path, chunk_size, columns):
+                yield path, chunk
+        return
+
+    queue = multiprocessing.Queue(maxsize=2 * workers)
+    with multiprocessing.Pool(min(workers, len(paths)), _init_reader,
+                              (queue,)) as pool:
+        for path in paths:
+            pool.apply_async(_read_file, (path, chunk_size, columns))
+        remaining = len(paths)
+        while remaining:
+            path, chunk = queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                remaining -= 1
+                continue
+            yield path, chunk
+
+
+def ingest_files(db, paths, chunk_size=10000, workers=1, progress=None):
+    """Appends the rows of one or more data files to the data tables.
+
+    The files may be plain or gzip compressed CSVs, Parquet or Arrow IPC
+    files. They are streamed in chunks and each chunk is committed on its
+    own, so memory use does not grow with the size of the files. Each row
+    is stored with the same new id in every table.
+
+    Args:
+        db: The SQLAlchemy database
+        paths: The files to load
+        chunk_size: The number of rows inserted and committed at a time
+        workers: The number of processes used to read the files
+        progress: Optional function called with (path, rows) after each
+            chunk is committed
+
+    Returns:
+        The total number of rows added
+    """
+    next_id = 1 + max(
+        db.session.scalar(db.select(db.func.max(
+            inspect(model).primary_key[0]))) or 0
+        for model in table_columns())
+    total = 0
+    for path, chunk in iter_file_chunks(paths, chunk_size, workers):
+        rows = len(next(iter(chunk.values())))
+        insert_columns(db, chunk, next_id)
+        db.session.commit()
+        next_id += rows
+        total += rows
+        if progress:
+            progress(path, rows)
+    return total
@@ -0,0 +1,85 @@
+# Version counters for the tables, increased by every committed write
+from flask import current_app, has_app_context
+from sqlalchemy import event, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from src.models import Table_version
+
+
+def add_commit_listener(app, function):
+    """Registers a function to call after a write is committed in the app.
+
+    The functions are kept on the app, so the caches of an app stop
+    receiving commits when the app is gone.
+
+    Args:
+        app: The Flask app
+        function: Called with the set of the names of the tables written
+    """
+    app.extensions.setdefault('commit_listeners', []).append(function)
+
+
+def bump_versions(session, tables):
+    """Increases the version of each table in the session's transaction.
+
+    Writes made with the ORM or with insert/update/delete statements on a
+    model are counted automatically. Call this for writes that bypass the
+    session, e.g. Connection.exec_driver_sql().
+
+    Args:
+        session: The SQLAlchemy session making the write
+        tables: Names of the tables written to
+    """
+    tables = set(tables) - {Table_version.__tablename__}
+    if not tables:
+        return
+    connection = session.connection()
+    for table in sorted(tables):
+        statement = insert(Table_version).values(table_name=table, version=1)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[Table_version.table_name],
+            set_={'version': Table_version.version + 1}))
+    session.info.setdefault('changed_tables', set()).update(tables)
+
+
+def table_versions(session, tables):
+    """Returns the current version of each table, 0 if never written."""
+    versions = dict.fromkeys(tables, 0)
+    versions.update(session.execute(
+        select(Table_version.table_name, Table_version.version)
+        .where(Table_version.table_name.in_(tables))).all())
+    return versions
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_writes(session, flush_context):
+    """Increases the versions of the tables changed by a flush."""
+    objects = [*session.new, *session.deleted,
+               *(o for o in session.dirty if session.is_modified(o))]
+    bump_versions(session, {o.__table__.name for o in objects})
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _count_statement_writes(orm_execute_state):
+    """Increases the version of a table written to by a DML statement."""
+    if orm_execute_state.is_insert or orm_execute_state.is_update \
+            or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            bump_versions(orm_execute_state.session,
+                          {table.name for table in mapper.tables})
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_commit(session):
+    """Tells the app's commit listeners which tables a commit changed."""
+    tables = session.info.pop('changed_tables', None)
+    if tables and has_app_context():
+        for function in current_app.extensions.get('commit_listeners', ()):
+            function(tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('changed_tables', None)
@@ -34,6 +34,7 @@ def app():
     test_cfg = {
         "TESTING": True,
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(db_path),
+        "RESPONSE_CACHE_BACKEND": "memory",
         # "SQLALCHEMY_ECHO": True
     }
     app = create_app(test_config=test_cfg)
@@ -47,6 +48,26 @@ def app():
     os.unlink(db_path)
 
 
+@pytest.fixture(scope='function')
+def fresh_app(tmp_path):
+    """Fixture that creates a test app with its own empty database.
+
+    Use this for tests that replace or reload the data tables so that the
+    shared test database is left untouched. The routes are registered with
+    the session app only, so use this app for database and CLI tests.
+
+    Returns:
+        app A Flask app with a test config and a newly seeded database
+    """
+    test_cfg = {
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(
+            tmp_path.joinpath('src_fresh.sqlite')),
+        "RESPONSE_CACHE_BACKEND": "memory",
+    }
+    yield create_app(test_config=test_cfg)
+
+
 @pytest.fixture()
 def client(app):
     return app.test_client()
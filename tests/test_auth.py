@@ -1,4 +1,15 @@
 # Authentication tests
+import time
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash
+
+from src import db
+from src.models import User
+from src.passwords import PasswordHasher, needs_rehash
+
+
 def test_register_success(client, random_user_json):
     """
     GIVEN a valid format email and password for a user not already registered
@@ -59,3 +70,196 @@ def test_user_logged_in_user_can_edit_teacher(app, client, new_user,
                             headers=headers)
     assert response.json == {"message": f"Teacher {code} updated."}
     assert response.status_code == 200
+
+
+def test_token_cache(app, client, new_user, random_user_json, new_teacher):
+    """
+    GIVEN two registered users that are logged in
+    WHEN protected requests are made with their tokens
+    THEN each token's user should be cached after its first request
+    AND registering another user should not drop the cached tokens
+    AND once one user is changed or deleted only its token should be
+    dropped, and a deleted user's token refused with 401
+    AND an invalid token should be refused with 401
+    """
+    client.post('/register', json=random_user_json)
+    login = client.post('/login', json=random_user_json).json
+    other_login = client.post('/login', json=new_user).json
+    code = new_teacher['teacher_id']
+    cache = app.extensions['token_cache']
+    cache.clear()
+
+    def patch(token):
+        return client.patch(f"/Teachers/{code}",
+                            headers={'Authorization': token},
+                            json={'time_period': 201819})
+
+    for token in (login['token'], login['token'], other_login['token']):
+        assert patch(token).status_code == 200
+    assert len(cache._entries) == 2
+
+    client.post('/register', json=dict(random_user_json,
+                                       email="x" + random_user_json['email'],
+                                       user_name="x" + random_user_json[
+                                           'user_name']))
+    assert len(cache._entries) == 2
+    client.patch(f"/Users/{login['user_id']}",
+                 json={'user_name': "renamed" + random_user_json['user_name']})
+    assert set(cache._by_user) == {other_login['user_id']}
+    assert patch(login['token']).status_code == 200
+    client.delete(f"/Users/{login['user_id']}")
+    assert set(cache._by_user) == {other_login['user_id']}
+    assert patch(login['token']).status_code == 401
+    assert patch('not a token').json == {
+        'message': "Invalid token. Please log in again."}
+
+
+def test_login_rehashes_password(app, client, random_user_json):
+    """
+    GIVEN a user whose password was hashed with other hash parameters
+    WHEN the user logs in
+    THEN the login should succeed
+    AND the stored hash should be remade with PASSWORD_HASH_METHOD
+    """
+    with app.app_context():
+        user = User(email=random_user_json['email'],
+                    user_name=random_user_json['user_name'],
+                    password_hash=generate_password_hash(
+                        random_user_json['password'], "pbkdf2:sha256:1000"))
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.user_id
+
+    response = client.post('/login', json=random_user_json)
+    assert response.status_code == 201
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        assert user.password_hash.startswith(
+            app.config['PASSWORD_HASH_METHOD'] + "$")
+        assert user.check_password(random_user_json['password'])
+        db.session.delete(user)
+        db.session.commit()
+
+
+def test_login_busy(app, client, new_user, monkeypatch):
+    """
+    GIVEN every password hashing worker is in use
+    WHEN a user logs in
+    THEN the status code should be 503 with a Retry-After header
+    """
+    hasher = app.extensions['password_hasher']
+    monkeypatch.setattr(hasher, "timeout", 0.01)
+    slots = hasher._slots
+    while slots.acquire(blocking=False):
+        pass
+    try:
+        response = client.post('/login', json=new_user)
+    finally:
+        for _ in range(app.config['PASSWORD_HASH_WORKERS']):
+            slots.release()
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_refresh_token_rotation(client, new_user, new_teacher):
+    """
+    GIVEN a user that is logged in with a refresh token
+    WHEN the refresh token is sent to /token/refresh
+    THEN a new token and refresh token should be returned with 201
+    AND the new token should open protected routes
+    AND using the old refresh token again should revoke the new one
+    """
+    login = client.post('/login', json=new_user).json
+    response = client.post('/token/refresh',
+                           json={'refresh_token': login['refresh_token']})
+    assert response.status_code == 201
+    tokens = response.json
+    assert tokens['user_id'] == login['user_id']
+    assert tokens['refresh_token'] != login['refresh_token']
+    response = client.patch(f"/Teachers/{new_teacher['teacher_id']}",
+                            headers={'Authorization': tokens['token']},
+                            json={'time_period': 201819})
+    assert response.status_code == 200
+
+    response = client.post('/token/refresh',
+                           json={'refresh_token': login['refresh_token']})
+    assert response.status_code == 401
+    response = client.post('/token/refresh',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 401
+    assert client.post('/token/refresh', json={}).status_code == 401
+
+
+def test_revoke_refresh_token(client, new_user):
+    """
+    GIVEN a user that is logged in with a refresh token
+    WHEN the refresh token is sent to /token/revoke
+    THEN it should no longer get new tokens from /token/refresh
+    """
+    login = client.post('/login', json=new_user).json
+    refresh = {'refresh_token': login['refresh_token']}
+    response = client.post('/token/revoke', json=refresh)
+    assert response.json == {'message': "Refresh token revoked."}
+    assert client.post('/token/refresh', json=refresh).status_code == 401
+    assert client.post('/token/revoke', json={}).status_code == 400
+
+
+def test_refresh_token_of_deleted_user(client, random_user_json):
+    """
+    GIVEN a user that is logged in with a refresh token
+    WHEN the user is deleted and a new user is given the same id
+    THEN the old refresh token should be refused with 401
+    AND a changed password should revoke the new user's refresh tokens
+    """
+    client.post('/register', json=random_user_json)
+    login = client.post('/login', json=random_user_json).json
+    client.delete(f"/Users/{login['user_id']}")
+    other_json = dict(random_user_json, email="new" + random_user_json['email'],
+                      user_name="new" + random_user_json['user_name'])
+    client.post('/register', json=other_json)
+    other_login = client.post('/login', json=other_json).json
+    assert other_login['user_id'] == login['user_id']
+    response = client.post('/token/refresh',
+                           json={'refresh_token': login['refresh_token']})
+    assert response.status_code == 401
+
+    client.patch(f"/Users/{other_login['user_id']}",
+                 json={'password_hash': "a new hash"})
+    response = client.post('/token/refresh',
+                           json={'refresh_token': other_login['refresh_token']})
+    assert response.status_code == 401
+    client.delete(f"/Users/{other_login['user_id']}")
+
+
+def test_needs_rehash_short_method_name(app, monkeypatch):
+    """
+    GIVEN PASSWORD_HASH_METHOD is a short method name without parameters
+    WHEN a hash made with that method is checked
+    THEN it should not need rehashing
+    """
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', "pbkdf2:sha256")
+    with app.app_context():
+        password_hash = generate_password_hash("password", "pbkdf2:sha256")
+        assert not needs_rehash(password_hash)
+        assert needs_rehash(generate_password_hash("password"))
+
+
+def test_password_hasher_timeout_keeps_slot():
+    """
+    GIVEN a password hasher with one worker
+    WHEN a job times out
+    THEN its slot should stay in use until the job finishes
+    """
+    hasher = PasswordHasher("scrypt:32768:8:1", workers=1, timeout=0.5)
+    try:
+        hasher._run(time.sleep, 0)
+        hasher.timeout = 0.05
+        with pytest.raises(ServiceUnavailable):
+            hasher._run(time.sleep, 1)
+        assert not hasher._slots.acquire(blocking=False)
+        with pytest.raises(ServiceUnavailable):
+            hasher._run(time.sleep, 0)
+        hasher.timeout = 5
+        assert hasher._run(time.sleep, 0) is None
+    finally:
+        hasher.shutdown()
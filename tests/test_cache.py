@@ -0,0 +1,121 @@
+# Tests for the GET response caches
+import time
+
+import pytest
+
+from src.cache import MemoryCache, SQLiteCache, TokenCache
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    """Returns a function that creates a cache of each backend."""
+    def make(max_bytes, ttl):
+        if request.param == "memory":
+            return MemoryCache(max_bytes, ttl)
+        return SQLiteCache(str(tmp_path.joinpath("cache.sqlite")),
+                           max_bytes, ttl)
+    return make
+
+
+def test_cache_get_and_invalidate(make_cache):
+    """
+    GIVEN a response cache with responses read from two tables
+    WHEN a table is invalidated, or its version changes
+    THEN only the responses read from that table should be dropped
+    """
+    cache = make_cache(max_bytes=1000, ttl=60)
+    cache.set("teachers", {"teacher": 1}, 200, [], b"[1]")
+    cache.set("users", {"user": 3, "feedback": 2}, 200, [], b"[2]")
+    assert cache.get("teachers", {"teacher": 1}) == (200, [], b"[1]")
+    assert cache.get("teachers", {"teacher": 2}) is None
+    assert cache.get("teachers", {"teacher": 1}) is None
+
+    cache.invalidate({"feedback"})
+    assert cache.get("users", {"user": 3, "feedback": 2}) is None
+    assert cache.hits == 1
+    assert cache.misses == 3
+
+
+def test_cache_memory_bound_and_ttl(make_cache):
+    """
+    GIVEN a response cache with a memory bound and a time to live
+    WHEN more responses are added than fit
+    THEN the least recently used responses should be dropped
+    AND responses should be dropped once their time to live has passed
+    """
+    cache = make_cache(max_bytes=25, ttl=60)
+    for key in ("a", "b"):
+        cache.set(key, {"t": 1}, 200, [], b"0123456789")
+        time.sleep(0.01)
+    cache.get("a", {"t": 1})
+    time.sleep(0.01)
+    cache.set("c", {"t": 1}, 200, [], b"0123456789")
+    assert cache.get("b", {"t": 1}) is None
+    assert cache.get("a", {"t": 1}) is not None
+    assert cache.get("c", {"t": 1}) is not None
+
+    cache.set("too big", {"t": 1}, 200, [], b"x" * 26)
+    assert cache.get("too big", {"t": 1}) is None
+
+    cache.clear()
+    cache.ttl = 0.01
+    cache.set("a", {"t": 1}, 200, [], b"[]")
+    time.sleep(0.02)
+    assert cache.get("a", {"t": 1}) is None
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    """
+    GIVEN two SQLite response caches on the same file, as in two workers
+    WHEN one caches a response and the other invalidates its table
+    THEN the response should be served by both until it is invalidated
+    """
+    path = str(tmp_path.joinpath("cache.sqlite"))
+    first = SQLiteCache(path, max_bytes=1000, ttl=60)
+    second = SQLiteCache(path, max_bytes=1000, ttl=60)
+    headers = [("Content-Type", "application/json")]
+    first.set("teachers", {"teacher": 1}, 200, headers, b"[1]")
+    assert second.get("teachers", {"teacher": 1}) == (200, headers, b"[1]")
+
+    second.invalidate({"teacher"})
+    assert first.get("teachers", {"teacher": 1}) is None
+
+
+def test_token_cache_bound_and_expiry():
+    """
+    GIVEN a token cache that holds two tokens
+    WHEN a third token is added, or a token expires
+    THEN the least recently used or expired token should be dropped
+    AND invalidating a user should drop only that user's tokens
+    """
+    cache = TokenCache(max_entries=2, ttl=60)
+    now = time.time()
+    cache.set("expired", 4, now - 1, {"user_id": 4})
+    assert cache.get("expired") is None
+    cache.set("a", 1, now + 60, {"user_id": 1})
+    cache.set("b", 2, now + 60, {"user_id": 2})
+    assert cache.get("a") == {"user_id": 1}
+    cache.set("c", 3, now + 60, {"user_id": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    cache.invalidate({2, 3})
+    assert cache.get("c") is None
+    assert cache.get("a") is not None
+    cache.invalidate({1})
+    assert cache.get("a") is None
+
+
+def test_sqlite_cache_reads_do_not_write(tmp_path):
+    """
+    GIVEN a SQLite response cache with a cached response
+    WHEN the response is read, and a stale version of it is read
+    THEN the cache file should not be written to
+    """
+    cache = SQLiteCache(str(tmp_path.joinpath("cache.sqlite")), 1000, 60)
+    cache.set("teachers", {"teacher": 1}, 200, [], b"[1]")
+    connection = cache._connection()
+    changes = connection.total_changes
+    assert cache.get("teachers", {"teacher": 1}) == (200, [], b"[1]")
+    assert cache.get("teachers", {"teacher": 2}) is None
+    assert connection.total_changes == changes
@@ -0,0 +1,138 @@
+# Tests for the Flask CLI commands
+import csv
+import gzip
+
+import pyarrow.csv
+import pyarrow.ipc
+import pyarrow.parquet
+from sqlalchemy import func
+from src import db
+from src.models import Teacher, Age_group
+from src.utils import DATA_FILE
+
+
+def write_csv(path, rows):
+    """Writes rows with the same columns as the prepared CSV to path."""
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_reload_data(fresh_app, tmp_path):
+    """
+    GIVEN an app with a database seeded from the prepared CSV
+    AND a copy of the CSV with one row changed, one removed and one added
+    WHEN the reload-data command is run with the copy
+    THEN only those rows should be changed in the database
+    """
+    with open(DATA_FILE, 'r') as file:
+        rows = list(csv.DictReader(file))
+    rows[0]['n_total'] = '20000'
+    rows.pop(1)
+    added = dict(rows[-1], time_period='202223')
+    rows.append(added)
+    changed = tmp_path.joinpath('df_prepared.csv')
+    write_csv(changed, rows)
+
+    runner = fresh_app.test_cli_runner()
+    result = runner.invoke(args=['reload-data', str(changed)])
+    assert 'Inserted 1, updated 1 and deleted 1 rows.' in result.output
+
+    with fresh_app.app_context():
+        assert db.session.get(Teacher, 1).n_total == 20000
+        assert db.session.get(Teacher, 2) is None
+        assert db.session.get(Age_group, 2) is None
+        assert db.session.get(Teacher, 61).time_period == 202223
+        assert db.session.get(Age_group, 61).pct_total_age_u25 == int(
+            added['pct_total_age_u25'])
+
+    # Running it again finds nothing to change
+    result = runner.invoke(args=['reload-data', str(changed)])
+    assert 'Inserted 0, updated 0 and deleted 0 rows.' in result.output
+
+
+def test_reload_data_duplicate_keys(fresh_app):
+    """
+    GIVEN an app with a database seeded from the prepared CSV
+    AND the CSV ingested again, so each natural key is stored twice
+    WHEN the reload-data command is run
+    THEN it should fail naming the duplicate ids
+    AND no rows should be changed or deleted
+    """
+    runner = fresh_app.test_cli_runner()
+    runner.invoke(args=['ingest', str(DATA_FILE)])
+
+    result = runner.invoke(args=['reload-data'])
+    assert result.exit_code != 0
+    assert 'Duplicate rows in the database' in result.output
+    assert 'ids 1 and 61' in result.output
+
+    with fresh_app.app_context():
+        num_rows = db.session.scalar(
+            db.select(func.count(Teacher.teacher_id)))
+        assert num_rows == 120
+
+
+def test_ingest(fresh_app, tmp_path):
+    """
+    GIVEN an app with a database seeded from the prepared CSV
+    AND a plain and a gzip compressed copy of the CSV
+    WHEN the ingest command is run on both files with two workers
+    THEN every row of both files should be added under a new id
+    AND each row should have the same id in every table
+    """
+    compressed = tmp_path.joinpath('df_prepared.csv.gz')
+    with open(DATA_FILE, 'rb') as file, gzip.open(compressed, 'wb') as gz:
+        gz.write(file.read())
+    with open(DATA_FILE, 'r') as file:
+        rows = list(csv.DictReader(file))
+
+    runner = fresh_app.test_cli_runner()
+    result = runner.invoke(args=['ingest', str(DATA_FILE), str(compressed),
+                                 '--chunk-size', '7', '--workers', '2'])
+    assert result.exit_code == 0
+    assert 'Added 120 rows from 2 file(s)' in result.output
+
+    expected = {(r['time_period'], r['qts_status'], r['n_total'],
+                 r['pct_total_age_u25']) for r in rows}
+    with fresh_app.app_context():
+        num_rows = db.session.scalar(
+            db.select(func.count(Age_group.age_group_id)))
+        assert num_rows == 180
+        for row_id in range(61, 181):
+            teacher = db.session.get(Teacher, row_id)
+            age_group = db.session.get(Age_group, row_id)
+            assert (str(teacher.time_period), teacher.qts_status,
+                    str(teacher.n_total),
+                    str(age_group.pct_total_age_u25)) in expected
+
+
+def test_ingest_parquet_and_arrow(fresh_app, tmp_path):
+    """
+    GIVEN an app with a database seeded from the prepared CSV
+    AND Parquet and Arrow IPC copies of the CSV
+    WHEN the ingest command is run on both files
+    THEN the rows of both files should be added with the same values as the
+    CSV
+    """
+    table = pyarrow.csv.read_csv(DATA_FILE)
+    parquet = tmp_path.joinpath('df_prepared.parquet')
+    pyarrow.parquet.write_table(table, parquet, row_group_size=25)
+    arrow = tmp_path.joinpath('df_prepared.arrow')
+    with pyarrow.ipc.new_file(arrow, table.schema) as writer:
+        writer.write_table(table, max_chunksize=25)
+
+    runner = fresh_app.test_cli_runner()
+    result = runner.invoke(args=['ingest', str(parquet), str(arrow),
+                                 '--chunk-size', '10'])
+    assert result.exit_code == 0
+    assert 'Added 120 rows from 2 file(s)' in result.output
+
+    with fresh_app.app_context():
+        for row_id in (1, 61, 121):
+            teacher = db.session.get(Teacher, row_id)
+            age_group = db.session.get(Age_group, row_id)
+            assert (teacher.time_period, teacher.qts_status, teacher.n_total,
+                    age_group.pct_total_age_u25) == (201718, 'Awarded QTS',
+                                                     20503, 81)
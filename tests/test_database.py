@@ -1,7 +1,12 @@
 # A test that includes using a context to check the database
-from sqlalchemy import func
+import csv
+
+import pytest
+from sqlalchemy import func, inspect
 from src import db
-from src.models import Teacher, User
+from src.models import Teacher, User, Data_source
+from src.trends import load_records
+from src.utils import DATA_FILE, table_columns, add_data, file_fingerprint
 
 
 def test_post_teacher_database_update(client, app):
@@ -62,3 +67,93 @@ def test_database_after_insert(test_client, random_user_json):
     db.session.commit()
     num_rows_end = db.session.scalar(db.select(func.count(User.user_id)))
     assert num_rows_end - num_rows_start == 1
+
+
+def test_add_data_loads_every_table(test_client):
+    """
+    GIVEN a test_client with an application context
+    AND the prepared CSV data file
+    WHEN the app has been created
+    THEN every data table should hold each CSV row under the same id
+    """
+    with open(DATA_FILE, 'r') as file:
+        rows = list(csv.DictReader(file))
+    for model, columns in table_columns().items():
+        pk = inspect(model).primary_key[0]
+        last = db.session.execute(
+            db.select(model).where(pk == len(rows))).scalar_one()
+        for column in columns:
+            assert str(getattr(last, column)) == rows[-1][column]
+
+
+def test_add_data_skips_unchanged_file(test_client):
+    """
+    GIVEN a test_client with an application context
+    AND a database that was seeded from the prepared CSV
+    WHEN add_data is called again with the same file
+    THEN the data tables should not change
+    """
+    num_rows_start = db.session.scalar(
+        db.select(func.count(Teacher.teacher_id)))
+    add_data(db)
+    num_rows_end = db.session.scalar(db.select(func.count(Teacher.teacher_id)))
+    assert num_rows_end == num_rows_start
+
+
+def test_add_data_changed_file(fresh_app, tmp_path):
+    """
+    GIVEN an app with a database seeded from the prepared CSV
+    AND a changed copy of the CSV
+    WHEN add_data is called with the changed file
+    THEN a RuntimeError should be raised unless RESEED_ON_DATA_CHANGE is set
+    AND the data should be reloaded when it is set
+    """
+    with open(DATA_FILE, 'r') as file:
+        lines = file.readlines()
+    changed = tmp_path.joinpath('df_prepared.csv')
+    changed.write_text(''.join(lines[:11]))
+
+    with fresh_app.app_context():
+        with pytest.raises(RuntimeError):
+            add_data(db, changed)
+
+        fresh_app.config['RESEED_ON_DATA_CHANGE'] = True
+        add_data(db, changed)
+        num_rows = db.session.scalar(db.select(func.count(Teacher.teacher_id)))
+        source = db.session.get(Data_source, 1)
+    assert num_rows == 10
+    assert source.file_hash == file_fingerprint(changed)
+
+
+def test_commit_listeners_are_per_app(app, fresh_app):
+    """
+    GIVEN two apps, each with its own response cache
+    WHEN a write to the teacher table is committed in one app
+    THEN only that app's cache should be invalidated
+    """
+    cache = app.extensions['response_cache']
+    fresh_cache = fresh_app.extensions['response_cache']
+    for response_cache in (cache, fresh_cache):
+        response_cache.set("teachers", {"teacher": 1}, 200, [], b"[]")
+    with fresh_app.app_context():
+        db.session.get(Teacher, 1).n_total += 1
+        db.session.commit()
+    assert fresh_cache.get("teachers", {"teacher": 1}) is None
+    assert cache.get("teachers", {"teacher": 1}) is not None
+    cache.clear()
+
+
+def test_trend_records_are_per_app(app, fresh_app):
+    """
+    GIVEN two apps with their own databases
+    WHEN the records for trends are loaded in each app
+    THEN each app should keep its own copy of the records
+    """
+    with app.app_context():
+        records = load_records(db.session)
+    with fresh_app.app_context():
+        fresh_records = load_records(db.session)
+        assert load_records(db.session) is fresh_records
+    assert fresh_records is not records
+    assert app.extensions['trend_records'][1] is records
+    assert fresh_app.extensions['trend_records'][1] is fresh_records
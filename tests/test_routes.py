@@ -1,3 +1,12 @@
+import json
+
+import pytest
+
+from src import db
+from src.cube import update_cube
+from src.models import Cube_cell
+
+
 # Test User GET, POST and DELETE Routes
 def test_get_Users_status_code(client):
     """
@@ -49,6 +58,29 @@ def test_delete_User(client, new_users):
     assert response.json['message'] == f'User deleted with id= {code}'
 
 
+def test_delete_User_with_feedback(client):
+    """
+    GIVEN a Flask test client
+    AND a new user who has feedback
+    WHEN a DELETE request is made to /Users/<code>
+    THEN the response status code should be 404
+    AND the user and their feedback should be kept
+    """
+    user = client.post("/Users", json=[{
+        "email": "has_feedback", "password_hash": "has_feedback",
+        "user_name": "has_feedback"}]).json[0]
+    feedback = client.post("/Feedbacks", json=[{
+        "feedback_time": "2024-01-01T09:00:00Z",
+        "feedback_content": "Keep me", "user_id": user["user_id"]}]).json[0]
+    response = client.delete(f"/Users/{user['user_id']}")
+    assert response.status_code == 404
+    assert client.get(f"/Users/{user['user_id']}").json["feedback"] == \
+        [feedback["feedback_id"]]
+
+    client.delete(f"/Feedbacks/{feedback['feedback_id']}")
+    assert client.delete(f"/Users/{user['user_id']}").status_code == 200
+
+
 # Test Feedback GET, POST and DELETE Routes
 def test_get_Feedbacks_status_code(client):
     """
@@ -585,3 +617,595 @@ def test_delete_Teacher(client, new_teacher):
     response = client.delete(f"/Teachers/{code}")
     assert response.status_code == 200
     assert response.json['message'] == f'Teacher deleted with id= {code}'
+
+
+# Test pagination of the list routes
+def test_get_Teachers_pages(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Teachers with a limit
+    AND the cursor in the X-Next-Cursor header is used to get the next page
+    THEN each page should contain the next rows in id order
+    """
+    response = client.get("/Teachers?limit=5")
+    assert response.status_code == 200
+    assert [t['teacher_id'] for t in response.json] == [1, 2, 3, 4, 5]
+    assert 'rel="next"' in response.headers['Link']
+
+    cursor = response.headers['X-Next-Cursor']
+    response = client.get(f"/Teachers?limit=5&after={cursor}")
+    assert [t['teacher_id'] for t in response.json] == [6, 7, 8, 9, 10]
+
+
+def test_get_Genders_invalid_page(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Genders with an invalid limit or cursor
+    THEN the response status code should be 400
+    """
+    assert client.get("/Genders?limit=0").status_code == 400
+    assert client.get("/Genders?limit=abc").status_code == 400
+    assert client.get("/Genders?after=not-a-cursor").status_code == 400
+
+
+# Test the fields query parameter
+def test_get_Teachers_fields(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Teachers with fields and a limit
+    THEN each teacher in the response should only have those fields
+    AND the next page should follow on from the first
+    """
+    response = client.get("/Teachers?fields=time_period,n_total&limit=2")
+    assert response.status_code == 200
+    assert response.json == [{'time_period': 201718, 'n_total': 20503},
+                             {'time_period': 201718, 'n_total': 25490}]
+    cursor = response.headers['X-Next-Cursor']
+    response = client.get(
+        f"/Teachers?fields=time_period,n_total&limit=1&after={cursor}")
+    assert response.json == [{'time_period': 201718, 'n_total': 1304}]
+
+
+def test_get_Ethnicity_fields(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Ethnicities/1 with fields
+    THEN the response should only have those fields
+    AND an unknown field should return status code 400
+    """
+    response = client.get(
+        "/Ethnicities/1?fields=ethnicity_id,pct_total_ethnic_asian")
+    assert response.json == {'ethnicity_id': 1, 'pct_total_ethnic_asian': 78}
+    response = client.get("/Ethnicities/1?fields=password")
+    assert response.status_code == 400
+
+
+# Test the fast serialization gives the same output as the schemas
+@pytest.mark.parametrize("path", [
+    "/Users", "/Feedbacks?fields=feedback_id,feedback_content",
+    "/Age_groups", "/Genders", "/Ethnicities", "/Employments",
+    "/Course_levels", "/Disabilities", "/Teachers",
+    "/Teachers?fields=n_total,qts_status&limit=3", "/Teachers/4",
+    "/Disabilities/7?fields=pct_total_disability"])
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_fast_serialization_parity(app, client, monkeypatch, path,
+                                   use_orjson):
+    """
+    GIVEN a Flask test client
+    WHEN the same GET request is made with and without FAST_SERIALIZATION
+    THEN the JSON in both responses should be the same
+    AND without orjson the response bodies should be byte for byte the same
+    """
+    # Compare the database reads, not the snapshot
+    monkeypatch.delitem(app.extensions, "snapshot")
+    expected = client.get(path)
+    monkeypatch.setitem(app.config, "FAST_SERIALIZATION", True)
+    monkeypatch.setitem(app.config, "FAST_SERIALIZATION_ORJSON", use_orjson)
+    response = client.get(path)
+    assert response.status_code == expected.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json == expected.json
+    assert response.headers.get("Link") == expected.headers.get("Link")
+    if not use_orjson:
+        assert response.data == expected.data
+
+
+# Test reads from the snapshot give the same output as the database
+@pytest.mark.parametrize("path", [
+    "/Age_groups", "/Genders", "/Ethnicities", "/Employments",
+    "/Course_levels", "/Disabilities", "/Teachers", "/Teachers/4",
+    "/Teachers/999", "/Teachers?fields=n_total,qts_status&limit=7",
+    "/Genders?after=YWZ0ZXI6NTg=&limit=2", "/Disabilities/x",
+    "/Records", "/Records?qts_status=Total&time_period=201920&limit=2",
+    "/aggregate", "/aggregate?qts_status=None",
+    "/aggregate?group_by=time_period,qts_status&employment_status=Total",
+    "/trends/pct_total_ethnic_white"])
+def test_snapshot_parity(app, client, monkeypatch, path):
+    """
+    GIVEN a Flask test client
+    WHEN the same GET request is made with and without the snapshot
+    THEN the JSON and the next page links of both responses should be the
+    same
+    """
+    monkeypatch.delitem(app.extensions, "response_cache")
+    response = client.get(path)
+    monkeypatch.delitem(app.extensions, "snapshot")
+    expected = client.get(path)
+    assert response.status_code == expected.status_code == 200
+    assert response.json == pytest.approx(expected.json) \
+        if path.startswith("/trends") else response.json == expected.json
+    assert response.headers.get("Link") == expected.headers.get("Link")
+
+
+def test_snapshot_after_write(app, client, new_gender):
+    """
+    GIVEN a Flask test client and a gender added after the snapshot was read
+    WHEN the gender is read, changed and read again
+    THEN the reads should return the gender as it was last written
+    """
+    code = new_gender["gender_id"]
+    assert client.get(f"/Genders/{code}").json == new_gender
+    changed = dict(new_gender, pct_total_sex_m=1)
+    client.post("/Genders", json=changed)
+    assert client.get(f"/Genders/{code}").json == changed
+    assert changed in client.get("/Genders").json
+
+
+# Test streamed responses
+@pytest.mark.parametrize("fast", [True, False])
+def test_get_Teachers_ndjson(app, client, monkeypatch, fast):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Teachers accepting application/x-ndjson
+    THEN the response should be streamed with one teacher per line
+    AND the teachers should be the same as the JSON list
+    """
+    monkeypatch.setitem(app.config, "FAST_SERIALIZATION", fast)
+    monkeypatch.setitem(app.config, "STREAM_BATCH_SIZE", 7)
+    expected = client.get("/Teachers").json
+    response = client.get("/Teachers",
+                          headers={"Accept": "application/x-ndjson"})
+    assert response.is_streamed
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    lines = response.data.decode().splitlines()
+    assert [json.loads(line) for line in lines] == expected
+
+
+@pytest.mark.parametrize("path", [
+    "/Users?stream=json", "/Genders?stream=json&limit=3",
+    "/Genders?stream=json&limit=3&fields=gender_id",
+    "/Feedbacks?stream=json"])
+def test_get_stream_json(client, path):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made with ?stream=json
+    THEN the response should be a streamed JSON array of the same rows as
+    the JSON list
+    """
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.is_streamed
+    expected = client.get(path.replace("stream=json", "")).json
+    assert response.json == expected
+
+
+# Test conditional GET requests
+def test_get_Age_groups_etag(client, new_age_group):
+    """
+    GIVEN a Flask test client
+    AND the ETag of the response to a GET request to /Age_groups
+    WHEN the request is repeated with the ETag in If-None-Match
+    THEN the response status code should be 304
+    AND after an age group is deleted the status code should be 200 with a
+    new ETag
+    """
+    response = client.get("/Age_groups")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    response = client.get("/Age_groups", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+
+    # A different query gets a different ETag
+    response = client.get("/Age_groups?limit=2")
+    assert response.headers["ETag"] != etag
+
+    client.delete(f"/Age_groups/{new_age_group['age_group_id']}")
+    response = client.get("/Age_groups", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_get_Age_group_cached(app, client, new_age_group):
+    """
+    GIVEN a Flask test client
+    WHEN the same GET request is made to /Age_groups/<id> twice
+    THEN the second response should come from the response cache
+    AND after the age group is changed the next response should not
+    """
+    cache = app.extensions["response_cache"]
+    code = new_age_group['age_group_id']
+    first = client.get(f"/Age_groups/{code}")
+    hits = cache.hits
+    second = client.get(f"/Age_groups/{code}")
+    assert cache.hits == hits + 1
+    assert second.json == first.json == new_age_group
+
+    changed = dict(new_age_group, pct_total_age_u25=21)
+    client.post("/Age_groups", json=changed)
+    response = client.get(f"/Age_groups/{code}")
+    assert cache.hits == hits + 1
+    assert response.json == changed
+
+
+# Test the joined records
+def test_get_Records(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Records filtered on two columns
+    THEN each record should have the columns of all the tables for its id
+    """
+    response = client.get(
+        "/Records?qts_status=Awarded QTS&time_period=201819"
+        "&time_period=201920")
+    assert response.status_code == 200
+    records = response.json
+    assert records
+    for record in records:
+        assert record["qts_status"] == "Awarded QTS"
+        assert record["time_period"] in (201819, 201920)
+    record = records[0]
+    teacher = client.get(f"/Teachers/{record['record_id']}").json
+    gender = client.get(f"/Genders/{record['record_id']}").json
+    course_level = client.get(
+        f"/Course_levels/{record['record_id']}").json
+    assert record["n_total"] == teacher["n_total"]
+    assert record["pct_total_sex_f"] == gender["pct_total_sex_f"]
+    assert record["course_level_recoded"] == \
+        course_level["course_level_recoded"]
+
+
+def test_get_Records_pages(client):
+    """
+    GIVEN a Flask test client
+    WHEN pages of /Records with selected fields are requested
+    THEN the pages should hold all the records in record_id order
+    AND invalid filter values should return 400
+    """
+    expected = client.get("/Records?fields=record_id,n_total").json
+    records = []
+    path = "/Records?fields=record_id,n_total&limit=25"
+    while path:
+        response = client.get(path)
+        records += response.json
+        path = response.headers.get("Link", "").partition(">")[0][1:]
+    assert records == expected
+    assert set(records[0]) == {"record_id", "n_total"}
+    assert client.get("/Records?time_period=latest").status_code == 400
+    assert client.get("/Records?fields=password").status_code == 400
+
+
+def test_get_aggregate(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /aggregate grouped by time_period
+    THEN each group should have the sum of n_total, the count and the means
+    of the percentages weighted by n_total of its records
+    """
+    filters = "qts_status=Awarded QTS&employment_status=Total"
+    response = client.get(f"/aggregate?group_by=time_period&{filters}")
+    assert response.status_code == 200
+    records = client.get(f"/Records?{filters}").json
+    groups = response.json
+    assert [group["time_period"] for group in groups] == \
+        sorted({record["time_period"] for record in records})
+    for group in groups:
+        rows = [record for record in records
+                if record["time_period"] == group["time_period"]]
+        n_total = sum(row["n_total"] for row in rows)
+        assert group["count"] == len(rows)
+        assert group["n_total"] == n_total
+        assert group["pct_total_sex_f"] == pytest.approx(sum(
+            row["pct_total_sex_f"] * row["n_total"] for row in rows)
+            / n_total)
+    assert client.get("/aggregate?group_by=n_total").status_code == 400
+
+
+def test_get_cube(client):
+    """
+    GIVEN a Flask test client
+    WHEN a teacher in a record is changed with a POST request to /Teachers
+    THEN the cells of the cube for its series should match /aggregate
+    before and after the change, with integer time periods
+    """
+    teacher = client.get("/Teachers/1").json
+    dimensions = {"course_level_recoded": "Postgraduate",
+                  "qts_status": "Awarded QTS",
+                  "employment_status": "Teaching in a state-funded school"}
+    series = "&".join(f"{name}={value}" for name, value in dimensions.items())
+
+    def check():
+        cells = client.get(f"/cube?{series}").json
+        periods = client.get(f"/aggregate?group_by=time_period&{series}").json
+        total = client.get(f"/aggregate?{series}").json[0]
+        assert cells == [dict(period, **dimensions) for period in periods] + \
+            [dict(total, time_period="Total", **dimensions)]
+        return cells[-1]["n_total"]
+
+    n_total = check()
+    client.post("/Teachers", json=dict(teacher, n_total=teacher["n_total"]
+                                       + 100))
+    assert check() == n_total + 100
+    client.post("/Teachers", json=teacher)
+    assert check() == n_total
+
+
+def test_delete_Teacher_updates_cube(client):
+    """
+    GIVEN a Flask test client
+    WHEN a teacher is deleted with a DELETE request and added back
+    THEN the 'Total' cell of its series should lose and regain its n_total
+    AND deleting the teacher twice should return 404
+    """
+    teacher = client.get("/Teachers/1").json
+    series = "course_level_recoded=Postgraduate&qts_status=Awarded+QTS" \
+        "&employment_status=Teaching+in+a+state-funded+school"
+
+    def total():
+        return client.get(f"/cube?{series}&time_period=Total").json[0][
+            "n_total"]
+
+    n_total = total()
+    response = client.delete("/Teachers/1")
+    assert response.json == {"message": "Teacher deleted with id= 1"}
+    assert total() == n_total - teacher["n_total"]
+    assert client.delete("/Teachers/1").status_code == 404
+    response = client.post("/Teachers", json=teacher)
+    assert response.json == {"message": "Teacher added with id= 1"}
+    assert total() == n_total
+
+
+def cell_dict(cell):
+    """Returns the values of a cube cell by column name."""
+    return {column.key: getattr(cell, column.key)
+            for column in Cube_cell.__table__.c}
+
+
+def test_post_Teacher_replacing_record_updates_cube(app, client):
+    """
+    GIVEN a Flask test client
+    WHEN a POST request replaces a teacher with one in another series
+    THEN the cube should match a full rebuild of the cube
+    """
+    teacher = client.get("/Teachers/1").json
+
+    def cells():
+        with app.app_context():
+            return db.session.execute(
+                db.select(Cube_cell).order_by(*Cube_cell.__table__.c)
+            ).scalars().all()
+
+    def rebuilt():
+        with app.app_context():
+            update_cube(db.session)
+            db.session.commit()
+        return cells()
+
+    try:
+        client.post("/Teachers", json=dict(teacher, qts_status="ZZZ"))
+        updated = [cell_dict(cell) for cell in cells()]
+        assert updated == [cell_dict(cell) for cell in rebuilt()]
+    finally:
+        client.post("/Teachers", json=teacher)
+    assert [cell_dict(cell) for cell in cells()] == \
+        [cell_dict(cell) for cell in rebuilt()]
+
+
+def test_get_trends(client):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /trends/<metric>
+    THEN the values of each series should match its cells in the cube
+    AND the changes and CAGR should be computed from the values
+    AND an unknown metric should return 404
+    """
+    trends = client.get("/trends/pct_total_sex_m").json
+    cells = client.get("/cube").json
+    assert len(trends) == len({(cell["course_level_recoded"],
+                                cell["qts_status"],
+                                cell["employment_status"])
+                               for cell in cells})
+    trend = trends[0]
+    series = {name: trend[name] for name in
+              ("course_level_recoded", "qts_status", "employment_status")}
+    values = {int(cell["time_period"]): cell["pct_total_sex_m"]
+              for cell in cells if cell["time_period"] != "Total"
+              and all(cell[name] == value for name, value in series.items())}
+    assert trend["value"] == pytest.approx(
+        [values.get(period) for period in trend["time_period"]])
+    first, last = trend["value"][0], trend["value"][-1]
+    assert trend["change"][1] == pytest.approx(
+        trend["value"][1] - trend["value"][0])
+    years = (trend["time_period"][-1] - trend["time_period"][0]) // 100
+    assert trend["cagr"] == pytest.approx((last / first) ** (1 / years) - 1)
+    assert client.get("/trends/teacher_id").status_code == 404
+
+
+@pytest.mark.parametrize("snapshot", [True, False])
+def test_get_Teachers_ids(app, client, monkeypatch, new_users, snapshot):
+    """
+    GIVEN a Flask test client
+    WHEN a GET request is made to /Teachers with a list of ids
+    THEN the teachers should be returned in the order of the ids
+    AND ids that are not found should be marked as not found
+    """
+    monkeypatch.delitem(app.extensions, "response_cache")
+    if not snapshot:
+        monkeypatch.delitem(app.extensions, "snapshot")
+    response = client.get("/Teachers?ids=9,1,999,9&fields=n_total")
+    assert response.status_code == 200
+    assert response.json == [
+        client.get("/Teachers/9?fields=n_total").json,
+        client.get("/Teachers/1?fields=n_total").json,
+        {"teacher_id": 999, "message": "Not found."},
+        client.get("/Teachers/9?fields=n_total").json]
+    response = client.get(f"/Users?ids={new_users['user_id']}")
+    assert response.json == [
+        client.get(f"/Users/{new_users['user_id']}").json]
+    assert client.get("/Teachers?ids=1,x").status_code == 400
+    assert client.get("/Teachers?ids=1&limit=2").status_code == 400
+    assert client.get("/Teachers?ids=1,2&stream=ndjson").status_code == 400
+    assert client.get("/Teachers?ids=1&stream=xml").status_code == 400
+
+
+# Test bulk writes
+def test_post_Feedbacks_bulk(client):
+    """
+    GIVEN a Flask test client
+    AND a JSON array of two valid feedbacks and one that is not valid
+    WHEN a POST request is made to /Feedbacks
+    THEN the response status code should be 207
+    AND the result of each item should be given in order
+    AND the valid feedbacks should be added
+    """
+    feedback = {"feedback_time": "2024-01-01T09:00:00Z", "user_id": 1,
+                "feedback_content": "Bulk feedback"}
+    response = client.post("/Feedbacks", json=[
+        feedback, {"feedback_content": "No time"}, feedback])
+    assert response.status_code == 207
+    results = response.json
+    assert [result["status"] for result in results] == [200, 400, 200]
+    assert "feedback_time" in results[1]["errors"]
+    ids = [results[0]["feedback_id"], results[2]["feedback_id"]]
+    added = client.get(f"/Feedbacks?ids={ids[0]},{ids[1]}").json
+    assert [item["feedback_content"] for item in added] == \
+        ["Bulk feedback"] * 2
+    for id in ids:
+        client.delete(f"/Feedbacks/{id}")
+
+
+def test_post_Teachers_ndjson(client):
+    """
+    GIVEN a Flask test client
+    AND an NDJSON body with a new teacher, a changed existing teacher and a
+    line that is not JSON
+    WHEN a POST request is made to /Teachers
+    THEN the new teacher should be added
+    AND the existing teacher should be reported as a conflict and unchanged
+    AND the line that is not JSON should be reported
+    """
+    teacher = client.get("/Teachers/2").json
+    new_teacher = dict(teacher, teacher_id=91)
+    body = json.dumps(new_teacher) + "\n" + \
+        json.dumps(dict(teacher, n_total=teacher["n_total"] + 1)) + \
+        "\n{not json\n"
+    response = client.post("/Teachers", data=body,
+                           content_type="application/x-ndjson")
+    assert response.status_code == 207
+    assert response.json == [
+        {"status": 200, "teacher_id": 91,
+         "message": "Teacher added with id= 91"},
+        {"status": 400, "errors": {
+            "_schema": ["Conflicts with an existing row."]}},
+        {"status": 400, "errors": {"_schema": ["Invalid JSON."]}}]
+    assert client.get("/Teachers/2").json == teacher
+    client.delete("/Teachers/91")
+
+
+def test_post_Users_bulk_conflict(client):
+    """
+    GIVEN a Flask test client
+    AND a JSON array of two new users with the same email
+    WHEN a POST request is made to /Users
+    THEN the first user should be added and the second reported as a
+    conflict
+    """
+    users = [{"email": "bulk@example.com", "password_hash": f"hash{i}",
+              "user_name": f"bulk{i}"} for i in range(2)]
+    response = client.post("/Users", json=users)
+    assert response.status_code == 207
+    first, second = response.json
+    assert first["status"] == 200
+    assert second == {"status": 400, "errors": {
+        "_schema": ["Conflicts with an existing row."]}}
+    client.delete(f"/Users/{first['user_id']}")
+
+
+def test_delete_Users_bulk_with_feedback(client):
+    """
+    GIVEN a Flask test client
+    AND two new users, one of whom has feedback
+    WHEN a DELETE request is made to /Users with both ids
+    THEN only the user without feedback should be deleted
+    """
+    ids = [user["user_id"] for user in client.post("/Users", json=[{
+        "email": f"bulk_delete{i}", "password_hash": f"bulk_delete{i}",
+        "user_name": f"bulk_delete{i}"} for i in range(2)]).json]
+    feedback = client.post("/Feedbacks", json=[{
+        "feedback_time": "2024-01-01T09:00:00Z",
+        "feedback_content": "Keep me", "user_id": ids[1]}]).json[0]
+
+    response = client.delete(f"/Users?ids={ids[0]},{ids[1]}")
+    assert response.json["deleted"] == 1
+    assert client.get(f"/Users/{ids[0]}").json == {}
+    assert client.get(f"/Users/{ids[1]}").json["feedback"] == \
+        [feedback["feedback_id"]]
+
+    client.delete(f"/Feedbacks/{feedback['feedback_id']}")
+    client.delete(f"/Users/{ids[1]}")
+
+
+def test_delete_Age_groups_bulk(client):
+    """
+    GIVEN a Flask test client and three new age groups
+    WHEN DELETE requests are made to /Age_groups with ids and with a filter
+    THEN the matching age groups should be deleted and counted
+    AND a request without a filter should return 400
+    """
+    age_groups = [{"age_group_id": id, "time_period": 209900,
+                   "pct_total_age_u25": 1, "pct_total_age_25andover": 2}
+                  for id in (71, 72, 73)]
+    assert client.post("/Age_groups", json=age_groups).status_code == 200
+
+    response = client.delete("/Age_groups?ids=71,99")
+    assert response.json["deleted"] == 1
+    response = client.delete("/Age_groups?time_period=209900")
+    assert response.status_code == 200
+    assert response.json == {"message": "Deleted 2 age groups.",
+                             "deleted": 2}
+    assert client.get("/Age_groups?ids=72").json == [
+        {"age_group_id": 72, "message": "Not found."}]
+    assert client.delete("/Age_groups").status_code == 400
+
+
+def test_post_batch(client):
+    """
+    GIVEN a Flask test client
+    WHEN a POST request is made to /batch with reads and writes
+    THEN each sub-request should get the response it gets on its own
+    AND a read after a write should see the write
+    AND a nested batch or a body that is not a list should return 400
+    """
+    age_group = {"age_group_id": 81, "time_period": 209900,
+                 "pct_total_age_u25": 1, "pct_total_age_25andover": 2}
+    response = client.post("/batch", json=[
+        {"path": "/Teachers/1"},
+        {"path": "/Genders?limit=2"},
+        {"method": "POST", "path": "/Age_groups", "body": age_group},
+        {"path": "/Age_groups/81"},
+        {"path": "/Age_groups/81", "method": "delete"},
+        {"path": "/Age_groups/81"},
+        {"path": "/batch", "method": "POST"},
+    ])
+    assert response.status_code == 200
+    results = response.json
+    assert [result["status"] for result in results] == \
+        [200, 200, 200, 200, 200, 200, 400]
+    assert results[0]["body"] == client.get("/Teachers/1").json
+    assert results[1]["body"] == client.get("/Genders?limit=2").json
+    assert "Link" in results[1]["headers"]
+    assert results[3]["body"] == age_group
+    assert results[5]["body"] == {}
+    assert client.post("/batch", json={}).status_code == 400